@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+# fastjson.py - JSON decoding shared by the relevance lab tools
+#
+# loads() decodes with ujson when it is installed, which is a few times
+# faster than the standard json module on our results files and dumps,
+# and with the json module otherwise (pip install ujson to speed things
+# up).
+#
+# extract_results() decodes a line of search results and keeps only the
+# parts that metrics need (the query, totalHits, and the pageId of each
+# row), so that the rest, which for results with --explain is mostly
+# deeply nested explanation trees, isn't kept around. Picking them out of
+# the line with regular expressions can't tell rows from other sections
+# of the results without taking longer than decoding the line.
+#
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+# http://www.gnu.org/copyleft/gpl.html
+
+import json
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def loads(s):
+    """Decode a JSON string, with ujson if it is available."""
+    if ujson is not None:
+        try:
+            return ujson.loads(s)
+        except (ValueError, OverflowError):
+            pass  # let json decode it, or raise a proper error
+    return json.loads(s)
+
+
+def extract_results(line):
+    """Decode the query, totalHits and rows[].pageId of a line of search
+    results, as {"query": ..., "totalHits": ..., "rows": [{"pageId": ...}]}.
+    Blank lines are empty results, and errors and lines without rows are
+    returned whole.
+    """
+    line = line.strip(' \t\n')
+    if line == '':
+        return {}
+    results = loads(line)
+    if 'error' in results or not isinstance(results.get('rows'), list):
+        return results
+    extracted = {'rows': [{'pageId': row['pageId']} if 'pageId' in row else {}
+                          for row in results['rows']]}
+    for key in ('query', 'totalHits'):
+        if key in results:
+            extracted[key] = results[key]
+    return extracted
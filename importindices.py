@@ -7,6 +7,35 @@
 # indices more than 30GB of disk space on the import runner will be
 # required.
 #
+# Several wikis are imported at once: downloads and imports run in
+# separate pools of threads, so the next wikis download while the
+# previous ones are imported, within limits on the number of concurrent
+# downloads and imports, and on the temp disk space in use.
+#
+# With --stream dumps aren't downloaded to disk first: each dump is
+# decompressed as it is downloaded and sent straight to the bulk api,
+# which needs no temp disk space at all.
+#
+# Documents are sent in batches of --batch-size bytes over up to
+# --concurrency keep-alive connections. When elasticsearch rejects
+# batches or documents because it is overloaded (429), they are retried
+# after backing off, with fewer concurrent requests. Any other failed
+# documents fail the import of the wiki.
+#
+# The progress of each import is checkpointed next to its dump in the
+# temp dir, and the dumps of failed imports are kept. Running again with
+# --resume continues their downloads, and skips the documents elasticsearch
+# already acknowledged. Streamed dumps are streamed again from the start.
+#
+# With --tune refreshes and replicas are turned off while importing into
+# an index, which makes bulk indexing several times faster, and turned
+# back on afterwards, whether the import succeeded or not.
+#
+# With --stats the progress of each import (bytes downloaded, documents
+# sent, acknowledged and failed, bulk request latencies and documents
+# indexed per second) is appended to a file as a line of JSON every
+# --stats-interval seconds, followed by a final line with the totals.
+#
 # This program is free software; you can redistribute it and/or modify
 # it under the terms of the GNU General Public License as published by
 # the Free Software Foundation; either version 2 of the License, or
@@ -24,11 +53,50 @@
 
 import argparse
 import datetime
+import fastjson
+import httplib
+import json
+import math
 import os
+import Queue
+import random
+import signal
+import socket
 import subprocess
 import sys
-import tempfile
+import threading
+import time
+import traceback
 import urllib2
+import urlparse
+import zlib
+
+# bytes read from a dump, and decompressed, at a time
+STREAM_CHUNK = 1024 * 1024
+# seconds to wait for a bulk response
+BULK_TIMEOUT = 120
+# statuses meaning elasticsearch is overloaded, and the request should be retried
+RETRY_STATUSES = (429, 503)
+# times a batch is retried before its documents count as failed
+BULK_RETRIES = 10
+# seconds to back off after the first rejection, doubling with each retry
+BACKOFF = 1
+BACKOFF_MAX = 60
+# successful batches before raising the number of concurrent requests again
+RAMP_UP_BATCHES = 20
+# index settings while importing with --tune. Cirrus indices auto expand
+# their replicas, which would override number_of_replicas.
+TUNED_SETTINGS = {
+    'refresh_interval': '-1',
+    'number_of_replicas': '0',
+    'auto_expand_replicas': 'false',
+}
+# values of TUNED_SETTINGS when the index doesn't set them
+DEFAULT_SETTINGS = {
+    'refresh_interval': '1s',
+    'number_of_replicas': '1',
+    'auto_expand_replicas': 'false',
+}
 
 
 def last_dump():
@@ -78,6 +146,873 @@ def build_dump_url(wiki, date, type):
         (date, wiki, date, type)
 
 
+# what talking to elasticsearch, and decoding what it says, can raise
+ES_ERRORS = (EnvironmentError, httplib.HTTPException, ValueError, LookupError, TypeError,
+             AttributeError)
+
+
+def es_request(method, url, body=None):
+    data = json.dumps(body) if body is not None else None
+    request = urllib2.Request(url, data, {'Content-Type': 'application/json'})
+    request.get_method = lambda: method
+    return fastjson.loads(urllib2.urlopen(request).read())
+
+
+def percentile(values, p):
+    """The nearest rank p-th percentile of values, or None if there are none"""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+
+def dump_path(temp_dir, src_url):
+    return os.path.join(temp_dir, os.path.basename(urlparse.urlsplit(src_url).path))
+
+
+def checkpoint_path(temp_dir, src_url):
+    return dump_path(temp_dir, src_url) + '.checkpoint'
+
+
+def load_checkpoint(path, src_url, size):
+    """Return the number of lines of the dump at src_url that a previous
+    import checkpointed at path, or 0 if there is no such checkpoint.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except IOError:
+        return 0
+    if checkpoint['src_url'] != src_url or checkpoint['size'] != size:
+        return 0  # a different dump
+    return checkpoint['lines']
+
+
+def save_checkpoint(path, src_url, size, lines):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'src_url': src_url, 'size': size, 'lines': lines}, f)
+    os.rename(path + '.tmp', path)
+
+
+def parse_size(size):
+    """Parse a number of bytes, with an optional K, M, G or T suffix"""
+    units = 'KMGT'
+    if size[-1:].upper() in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1:].upper()) + 1))
+    return int(size)
+
+
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'T'
+    return '%.1f%s' % (size, unit)
+
+
+class Aborted(Exception):
+    pass
+
+
+class BulkIndexer(object):
+    """Sends documents to an elasticsearch bulk api from a pool of threads,
+    each with its own keep-alive connection.
+
+    Lines are batched up to batch_size bytes, always keeping an action line
+    with its source line. add() blocks while all senders are busy. When
+    elasticsearch is overloaded, the number of concurrent requests is
+    halved, and raised again by one after RAMP_UP_BATCHES successes.
+
+    The first skip lines added are skipped. Whenever more lines are
+    acknowledged, checkpoint is called with the number of lines before
+    the first batch that isn't.
+
+    Attributes:
+        acked_lines: number of lines before the first batch not acknowledged
+        sent: number of documents sent
+        acked: number of documents acknowledged by elasticsearch
+        failed: number of documents elasticsearch failed to index
+        rejected: number of times documents were rejected and retried
+        errors: the first few errors of failed documents
+        started: time the indexer was created
+        bytes_sent: size of the bulk requests sent
+        latencies: seconds each bulk request took
+    """
+
+    def __init__(self, url, batch_size=5 * 1024 * 1024, concurrency=3, log=None, skip=0,
+                 checkpoint=None):
+        url = urlparse.urlsplit(url)
+        self.host = url.netloc
+        self.path = url.path
+        self.batch_size = batch_size
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.log = log or (lambda message: None)
+        self.skip = skip
+        self.checkpoint = checkpoint
+        self.batches = Queue.Queue(concurrency)
+        self.slots = threading.Condition()
+        self.active = 0
+        self.successes = 0
+        self.stopped = threading.Event()
+        self.error = None
+        self.partial = ''
+        self.lines = []
+        self.size = 0
+        self.line = 0
+        self.acked_lines = skip
+        self.done = {}
+        self.sent = 0
+        self.acked = 0
+        self.failed = 0
+        self.rejected = 0
+        self.errors = []
+        self.started = time.time()
+        self.bytes_sent = 0
+        self.latencies = []
+        self.threads = []
+        for _ in range(concurrency):
+            thread = threading.Thread(target=self.send_worker)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def add(self, data):
+        """Add a chunk of newline delimited bulk actions and sources"""
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        for line in lines:
+            if line == '':
+                continue
+            self.line += 1
+            if self.line <= self.skip:
+                continue
+            self.lines.append(line + '\n')
+            self.size += len(line) + 1
+            if self.size >= self.batch_size and len(self.lines) % 2 == 0:
+                self.submit()
+
+    def close(self):
+        """Send the rest of the documents, and wait for all of them to be
+        indexed. Raises RuntimeError if a bulk request failed.
+        """
+        self.add('\n')
+        if len(self.lines) % 2 != 0:
+            raise RuntimeError("Bulk action without a source: %s" % self.lines[-1][:200])
+        if self.lines:
+            self.submit()
+        self.join()
+        self.check()
+
+    def abort(self):
+        self.stopped.set()
+
+    def join(self):
+        for _ in self.threads:
+            self.batches.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def check(self):
+        if self.stopped.is_set():
+            raise Aborted()
+        if self.error is not None:
+            raise RuntimeError(self.error)
+
+    def submit(self):
+        self.check()
+        lines = self.lines
+        self.lines = []
+        self.size = 0
+        with self.slots:
+            self.sent += len(lines) / 2
+        self.batches.put((self.line - len(lines), lines))
+
+    def send_worker(self):
+        conn = None
+        for batch in iter(self.batches.get, None):
+            if self.stopped.is_set() or self.error is not None:
+                continue  # drain the queue, so add() doesn't block
+            try:
+                conn = self.send(conn, *batch)
+            except RuntimeError as e:
+                self.error = str(e)
+            except Exception as e:
+                # a dead sender would leave add() blocked forever
+                self.error = "Sending a batch failed: %r" % e
+        if conn is not None:
+            conn.close()
+
+    def send(self, conn, start, lines):
+        """Send a batch starting at line start, retrying the documents
+        rejected because elasticsearch is overloaded. Returns the connection
+        to reuse.
+        """
+        end = start + len(lines)
+        attempt = 0
+        failed = 0
+        while lines and not self.stopped.is_set():
+            reused = conn is not None
+            if conn is None:
+                conn = httplib.HTTPConnection(self.host, timeout=BULK_TIMEOUT)
+            self.acquire()
+            try:
+                data = ''.join(lines)
+                started = time.time()
+                conn.request('POST', self.path, data, {'Content-Type': 'application/x-ndjson'})
+                response = conn.getresponse()
+                status, body = response.status, response.read()
+                with self.slots:
+                    self.latencies.append(time.time() - started)
+                    self.bytes_sent += len(data)
+            except (socket.error, httplib.HTTPException) as e:
+                conn.close()
+                conn = None
+                if reused:
+                    continue  # the server closed the idle connection
+                status, body = None, str(e)
+            finally:
+                self.release()
+            if status == 200:
+                retry, errors = self.record(lines, body)
+                failed += errors
+                if not retry:
+                    self.succeeded()
+                    if not failed:
+                        self.acknowledge(start, end)
+                    break
+                if len(retry) < len(lines):
+                    attempt = 0  # some got through, so start backing off again
+                lines = retry
+            elif status not in RETRY_STATUSES + (None,):
+                raise RuntimeError("Bulk request failed with status %d: %s" % (status, body[:200]))
+            attempt += 1
+            with self.slots:
+                self.rejected += len(lines) / 2
+            if attempt > BULK_RETRIES:
+                self.record_failures(len(lines) / 2, "rejected %d times" % attempt)
+                break
+            self.throttled(attempt)
+        return conn
+
+    def record(self, lines, body):
+        """Count the acknowledged and failed documents of a bulk response,
+        and return the lines of the documents to retry, and the number of
+        failed documents.
+        """
+        try:
+            result = fastjson.loads(body)
+            items = result['items']
+            actions = [item.values()[0] for item in items]
+            statuses = [action.get('status', 0) for action in actions]
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            raise RuntimeError("Invalid bulk response: %s" % body[:200])
+        if len(items) * 2 != len(lines):
+            raise RuntimeError("Sent %d documents but got %d results" %
+                               (len(lines) / 2, len(items)))
+        if not result.get('errors'):
+            with self.slots:
+                self.acked += len(items)
+            return [], 0
+        retry = []
+        failed = 0
+        for i, (action, status) in enumerate(zip(actions, statuses)):
+            if status in RETRY_STATUSES:
+                retry.extend(lines[2 * i:2 * i + 2])
+            elif status >= 300 or 'error' in action:
+                error = action.get('error')
+                if isinstance(error, dict):
+                    error = '%s: %s' % (error.get('type'), error.get('reason'))
+                self.record_failures(1, '%s %s' % (action.get('_id'), error))
+                failed += 1
+            else:
+                with self.slots:
+                    self.acked += 1
+        return retry, failed
+
+    def acknowledge(self, start, end):
+        with self.slots:
+            self.done[start] = end
+            if self.acked_lines not in self.done:
+                return  # waiting for an earlier batch
+            while self.acked_lines in self.done:
+                self.acked_lines = self.done.pop(self.acked_lines)
+            if self.checkpoint is not None:
+                self.checkpoint(self.acked_lines)
+
+    def record_failures(self, count, error):
+        with self.slots:
+            self.failed += count
+            if len(self.errors) < 5:
+                self.errors.append(error)
+
+    def acquire(self):
+        with self.slots:
+            while self.active >= self.concurrency:
+                self.slots.wait()
+            self.active += 1
+
+    def release(self):
+        with self.slots:
+            self.active -= 1
+            self.slots.notify_all()
+
+    def succeeded(self):
+        with self.slots:
+            self.successes += 1
+            if self.successes >= RAMP_UP_BATCHES and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.successes = 0
+                self.slots.notify_all()
+
+    def throttled(self, attempt):
+        with self.slots:
+            self.successes = 0
+            if self.concurrency > 1:
+                self.concurrency /= 2
+                self.log("Rejected, lowering concurrency to %d" % self.concurrency)
+        # exponential backoff with jitter, so senders don't all retry at once
+        delay = min(BACKOFF * 2 ** (attempt - 1), BACKOFF_MAX)
+        self.stopped.wait(delay * random.uniform(0.5, 1))
+
+
+class WikiImport(object):
+    """The import of one wiki's dump
+
+    Attributes:
+        wiki: name of the wiki
+        src_url: url of the dump
+        index_url: url of the index to import into
+        dest_url: url of the bulk api of the index
+        size: size of the dump in bytes
+        temp_path: path the dump is downloaded to, unless it is streamed
+        checkpoint_path: path the progress of the import is saved to
+        resume_lines: number of lines of the dump already imported
+        status: queued, waiting for disk, downloading, downloaded,
+            importing, done or failed
+        error: why the import failed
+        timings: seconds spent in each phase, by name
+        docs: number of documents indexed
+        bytes_read: bytes of the dump read by the import so far
+        indexer: the BulkIndexer of the import, once it started
+    """
+
+    def __init__(self, wiki, src_url, index_url, size):
+        self.wiki = wiki
+        self.src_url = src_url
+        self.index_url = index_url
+        self.dest_url = index_url + '/_bulk'
+        self.size = size
+        self.temp_path = None
+        self.checkpoint_path = None
+        self.resume_lines = 0
+        self.status = 'queued'
+        self.error = None
+        self.timings = {}
+        self.docs = 0
+        self.bytes_read = 0
+        self.indexer = None
+
+
+class ImportScheduler(object):
+    """Imports wikis with a pool of download threads feeding a pool of
+    import threads, in order. Before downloading, a wiki reserves its dump
+    size of temp disk space: it waits for imports in progress to free some
+    when the dumps in flight would exceed disk_budget, or check_disk_space
+    fails for what is left to download, and fails if there is nothing
+    left to wait for.
+
+    With stream set there are no downloads, the import threads stream
+    the dumps instead. Each import sends its documents with a BulkIndexer
+    of batch_size and concurrency.
+
+    With resume set, imports continue from their checkpoints and partial
+    downloads. Otherwise they start over.
+
+    With tune set, the index settings in TUNED_SETTINGS are applied while
+    importing, and the index is refreshed afterwards. With force_merge
+    set, it is then merged down to that many segments.
+
+    With stats_path set, the progress of the imports is appended to that
+    file every stats_interval seconds, see import_stats().
+    """
+
+    def __init__(self, temp_dir, max_downloads=2, max_imports=1, disk_budget=None,
+                 stream=False, batch_size=5 * 1024 * 1024, concurrency=3, resume=False,
+                 tune=False, force_merge=None, stats_path=None, stats_interval=10):
+        self.temp_dir = temp_dir
+        self.max_downloads = max_downloads
+        self.max_imports = max_imports
+        self.disk_budget = disk_budget
+        self.stream = stream
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.resume = resume
+        self.tune = tune
+        self.force_merge = force_merge
+        self.stats_path = stats_path
+        self.stats_interval = stats_interval
+        self.stats_last = {}
+        self.finished = threading.Event()
+        self.downloads = Queue.Queue()
+        self.imports = Queue.Queue()
+        self.disk = threading.Condition()
+        self.reserved = []
+        self.processes = set()
+        self.indexers = set()
+        self.output = threading.Lock()
+        self.aborted = False
+
+    def log(self, imp, message):
+        with self.output:
+            print("[%s] %s" % (imp.wiki, message))
+            sys.stdout.flush()
+
+    def run(self, imports):
+        """Import all the WikiImports. Ctrl-C stops running commands and
+        cleans up the temp files.
+        """
+        for imp in imports:
+            self.prepare(imp)
+            if self.stream:
+                self.imports.put(imp)
+            else:
+                self.downloads.put(imp)
+        downloaders = []
+        if not self.stream:
+            downloaders = [self.start(self.download_worker) for _ in range(self.max_downloads)]
+        importers = [self.start(self.import_worker) for _ in range(self.max_imports)]
+        if self.stats_path is not None:
+            self.start(lambda: self.stats_worker(imports))
+        try:
+            for _ in downloaders:
+                self.downloads.put(None)
+            self.wait(downloaders)
+            for _ in importers:
+                self.imports.put(None)
+            self.wait(importers)
+        except KeyboardInterrupt:
+            self.abort()
+            self.wait(downloaders)
+            # the import threads may not have been told to stop yet
+            for _ in importers:
+                self.imports.put(None)
+            self.wait(importers)
+            raise
+        finally:
+            self.finished.set()
+            if self.stats_path is not None:
+                self.write_stats(imports, final=True)
+
+    def prepare(self, imp):
+        if not self.stream:
+            imp.temp_path = dump_path(self.temp_dir, imp.src_url)
+        imp.checkpoint_path = checkpoint_path(self.temp_dir, imp.src_url)
+        if self.resume:
+            imp.resume_lines = load_checkpoint(imp.checkpoint_path, imp.src_url, imp.size)
+        else:
+            self.remove_files(imp)
+
+    def remove_files(self, imp):
+        for path in (imp.temp_path, imp.checkpoint_path):
+            if path is not None and os.path.exists(path):
+                os.remove(path)
+
+    def start(self, target):
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def wait(self, threads):
+        for thread in threads:
+            # join with a timeout, so Ctrl-C gets through
+            while thread.is_alive():
+                thread.join(1)
+
+    def abort(self):
+        with self.disk:
+            self.aborted = True
+            self.disk.notify_all()
+        for proc in list(self.processes):
+            try:
+                os.killpg(proc.pid, signal.SIGTERM)
+            except OSError:
+                pass  # already gone
+        for indexer in list(self.indexers):
+            indexer.abort()
+
+    def stats_worker(self, imports):
+        while not self.finished.wait(self.stats_interval):
+            self.write_stats([imp for imp in imports
+                              if imp.status in ('downloading', 'importing')])
+
+    def write_stats(self, imports, final=False):
+        with open(self.stats_path, 'a') as f:
+            for imp in imports:
+                f.write(json.dumps(self.import_stats(imp, final), sort_keys=True) + '\n')
+
+    def import_stats(self, imp, final=False):
+        """Stats of the progress of an import. The rate of documents indexed
+        and latencies of bulk requests are since the last stats of the
+        import, or since it started when final is set.
+        """
+        now = time.time()
+        indexer = imp.indexer
+        acked = indexer.acked if indexer else 0
+        latencies = indexer.latencies if indexer else []
+        started = indexer.started if indexer else now
+        since, last_acked, last_requests = self.stats_last.get(imp.wiki, (started, 0, 0))
+        if final:
+            since = now - imp.timings.get('import', 0)
+            last_acked = last_requests = 0
+        else:
+            self.stats_last[imp.wiki] = (now, acked, len(latencies))
+        latencies = latencies[last_requests:]
+        stats = {
+            'time': round(now, 3),
+            'wiki': imp.wiki,
+            'status': imp.status,
+            'final': final,
+            'downloaded_bytes': self.downloaded_bytes(imp),
+            'read_bytes': imp.bytes_read,
+            'sent_bytes': indexer.bytes_sent if indexer else 0,
+            'docs_sent': indexer.sent if indexer else 0,
+            'docs_acked': acked,
+            'docs_failed': indexer.failed if indexer else 0,
+            'docs_rejected': indexer.rejected if indexer else 0,
+            'requests': len(latencies),
+            'concurrency': indexer.concurrency if indexer else 0,
+            'docs_per_sec': round((acked - last_acked) / (now - since), 1) if now > since else None,
+        }
+        for p in (50, 95, 99):
+            latency = percentile(latencies, p)
+            stats['latency_p%d' % p] = round(latency, 3) if latency is not None else None
+        if final:
+            stats['timings'] = imp.timings
+        return stats
+
+    def downloaded_bytes(self, imp):
+        if self.stream:
+            return imp.bytes_read
+        if imp.temp_path is not None and os.path.exists(imp.temp_path):
+            return os.path.getsize(imp.temp_path)
+        return imp.size if imp.status == 'done' else 0
+
+    def download_worker(self):
+        for imp in iter(self.downloads.get, None):
+            try:
+                imp.status = 'waiting for disk'
+                self.timed(imp, 'wait', self.reserve, imp)
+                imp.status = 'downloading'
+                self.timed(imp, 'download', self.download, imp)
+                imp.status = 'downloaded'
+                self.imports.put(imp)
+            except Exception as e:
+                self.fail(imp, e)
+
+    def import_worker(self):
+        for imp in iter(self.imports.get, None):
+            try:
+                imp.status = 'importing'
+                self.import_index(imp)
+                imp.status = 'done'
+                self.log(imp, 'Imported %d documents in %.0fs' % (imp.docs, imp.timings['import']))
+            except Exception as e:
+                self.fail(imp, e)
+            finally:
+                self.release(imp)
+
+    def import_index(self, imp):
+        settings = None
+        if self.tune:
+            settings = self.timed(imp, 'tune', self.tune_index, imp)
+        try:
+            if self.stream:
+                self.timed(imp, 'import', self.stream_import, imp)
+            else:
+                self.timed(imp, 'import', self.bulk_import, imp)
+        except BaseException:
+            if settings is not None:
+                # even when aborted, so the index isn't left without replicas,
+                # but the import failure is what the wiki reports
+                error = sys.exc_info()
+                try:
+                    self.timed_restore(imp, settings)
+                except Exception as e:
+                    self.log(imp, "Restoring the index settings failed too: %s" % e)
+                raise error[0], error[1], error[2]
+            raise
+        if settings is not None:
+            self.timed_restore(imp, settings)
+        if self.tune:
+            self.timed(imp, 'refresh', self.refresh_index, imp)
+        if self.force_merge is not None:
+            self.timed(imp, 'merge', self.merge_index, imp)
+
+    def timed(self, imp, phase, func, *args):
+        if self.aborted:
+            raise Aborted()
+        started = time.time()
+        try:
+            return func(*args)
+        finally:
+            imp.timings[phase] = time.time() - started
+
+    def timed_restore(self, imp, settings):
+        # not with timed(), which doesn't restore once aborted
+        started = time.time()
+        try:
+            self.restore_index(imp, settings)
+        finally:
+            imp.timings['restore'] = time.time() - started
+
+    def fail(self, imp, error):
+        imp.status = 'failed'
+        if isinstance(error, (Aborted, RuntimeError)):
+            imp.error = str(error) or error.__class__.__name__
+        else:
+            # not an expected failure, so show where it happened
+            imp.error = '%s: %s' % (error.__class__.__name__, error)
+            self.log(imp, traceback.format_exc().rstrip())
+        self.log(imp, 'Failed: %s' % imp.error)
+        self.release(imp)
+        if any(path is not None and os.path.exists(path)
+               for path in (imp.temp_path, imp.checkpoint_path)):
+            self.log(imp, 'Run again with --resume to continue from where it stopped')
+
+    def remaining_bytes(self, imp):
+        """Bytes of the dump left to download"""
+        written = 0
+        if os.path.exists(imp.temp_path):
+            written = os.path.getsize(imp.temp_path)
+        return max(imp.size - written, 0)
+
+    def pending_bytes(self):
+        """Bytes the downloads in progress have yet to write"""
+        return sum(self.remaining_bytes(imp) for imp in self.reserved
+                   if imp.status == 'downloading')
+
+    def reserve(self, imp):
+        with self.disk:
+            while True:
+                if self.aborted:
+                    raise Aborted()
+                in_flight = sum(r.size for r in self.reserved)
+                try:
+                    if self.disk_budget is not None and in_flight + imp.size > self.disk_budget:
+                        raise RuntimeError("Over disk budget. %d required but only %d left." %
+                                           (imp.size, self.disk_budget - in_flight))
+                    check_disk_space(self.remaining_bytes(imp) + self.pending_bytes(),
+                                     self.temp_dir)
+                    self.reserved.append(imp)
+                    return
+                except RuntimeError:
+                    if not self.reserved:
+                        raise  # nothing to wait for
+                # wait for an import to finish, or other processes to free disk
+                self.disk.wait(60)
+
+    def release(self, imp):
+        """Release the disk reserved by the import. The files of failed
+        imports are kept, to --resume them.
+        """
+        with self.disk:
+            if imp.status == 'done':
+                self.remove_files(imp)
+            if imp in self.reserved:
+                self.reserved.remove(imp)
+            self.disk.notify_all()
+
+    def run_command(self, what, cmd):
+        """Run a shell command, in its own process group so abort() can
+        stop the whole pipeline, and raise RuntimeError if it fails.
+        """
+        proc = subprocess.Popen(['/bin/bash', '-o', 'pipefail', '-c', cmd],
+                                preexec_fn=os.setsid)
+        self.processes.add(proc)
+        try:
+            status = proc.wait()
+        finally:
+            self.processes.discard(proc)
+        if self.aborted:
+            raise Aborted()
+        if status != 0:
+            raise RuntimeError("%s failed with status %d" % (what, status))
+
+    def download(self, imp):
+        written = imp.size - self.remaining_bytes(imp)
+        if written == 0:
+            self.log(imp, "Downloading %s (%s) to %s" %
+                     (imp.src_url, format_size(imp.size), imp.temp_path))
+            self.run_command('Download', "curl -fsS -o %s %s" % (imp.temp_path, imp.src_url))
+        elif written < imp.size:
+            self.log(imp, "Resuming download of %s at %s of %s" %
+                     (imp.src_url, format_size(written), format_size(imp.size)))
+            # -C - continues where the file ends, with a Range request
+            self.run_command('Download', "curl -fsS -C - -o %s %s" %
+                             (imp.temp_path, imp.src_url))
+
+    def bulk_import(self, imp):
+        self.log(imp, "Importing into %s" % imp.dest_url)
+        with open(imp.temp_path, 'rb') as source:
+            self.import_dump(imp, source)
+
+    def stream_import(self, imp):
+        self.log(imp, "Streaming %s (%s) into %s" %
+                 (imp.src_url, format_size(imp.size), imp.dest_url))
+        try:
+            source = urllib2.urlopen(imp.src_url, timeout=300)
+        except IOError as e:
+            raise RuntimeError("Stream failed: %s" % e)
+        self.import_dump(imp, source)
+
+    def import_dump(self, imp, source):
+        if imp.resume_lines > 0:
+            self.log(imp, "Skipping the first %d documents, already imported" %
+                     (imp.resume_lines / 2))
+        indexer = BulkIndexer(imp.dest_url, self.batch_size, self.concurrency,
+                              lambda message: self.log(imp, message), imp.resume_lines,
+                              lambda lines: save_checkpoint(imp.checkpoint_path, imp.src_url,
+                                                            imp.size, lines))
+        self.indexers.add(indexer)
+        imp.indexer = indexer
+        try:
+            try:
+                for data in self.read_dump(imp, source):
+                    indexer.add(data)
+            except (IOError, zlib.error) as e:
+                raise RuntimeError("Reading the dump failed: %s" % e)
+            indexer.close()
+        finally:
+            indexer.abort()
+            indexer.join()
+            self.indexers.discard(indexer)
+            imp.docs = imp.resume_lines / 2 + indexer.acked
+        if indexer.failed > 0:
+            raise RuntimeError("%d of %d documents failed, e.g. %s" %
+                               (indexer.failed, indexer.sent, indexer.errors[0]))
+
+    def read_dump(self, imp, source):
+        """Yield the decompressed dump, read from the source file a chunk
+        at a time. Only a chunk is held in memory at a time: when indexing
+        falls behind, so does reading, and in turn the download.
+        """
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        received = 0
+        reported = 0
+        while True:
+            if self.aborted:
+                raise Aborted()
+            data = source.read(STREAM_CHUNK)
+            if not data:
+                break
+            received += len(data)
+            imp.bytes_read = received
+            while data:
+                yield decompressor.decompress(data, STREAM_CHUNK)
+                if decompressor.unused_data:
+                    # dumps can be several gzip members back to back. The
+                    # rest of the chunk is in unused_data, and sometimes
+                    # also in unconsumed_tail, which mustn't be fed back.
+                    data = decompressor.unused_data
+                    yield decompressor.flush()
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                else:
+                    data = decompressor.unconsumed_tail
+            if imp.size and received * 10 / imp.size > reported:
+                reported = received * 10 / imp.size
+                self.log(imp, "Read %d%% of the dump, indexed %d documents" %
+                         (reported * 10, imp.indexer.acked))
+        yield decompressor.flush()
+        if imp.size and received != imp.size:
+            raise RuntimeError("Dump truncated after %d of %d bytes" % (received, imp.size))
+
+    def tune_index(self, imp):
+        """Apply TUNED_SETTINGS to the index, and return the settings they
+        replace. These are saved until they are restored, in case the
+        import dies before that, so the next import restores them instead
+        of the tuned ones.
+        """
+        path = self.settings_path(imp)
+        try:
+            if os.path.exists(path):
+                with open(path) as f:
+                    settings = json.load(f)
+            else:
+                current = es_request('GET', imp.index_url + '/_settings')
+                # the index may be an alias, the response is keyed by the index name
+                current = current.values()[0]['settings']['index']
+                settings = dict((name, current.get(name, DEFAULT_SETTINGS[name]))
+                                for name in TUNED_SETTINGS)
+                with open(path, 'w') as f:
+                    json.dump(settings, f)
+            es_request('PUT', imp.index_url + '/_settings', {'index': TUNED_SETTINGS})
+        except ES_ERRORS as e:
+            raise RuntimeError("Tuning the index failed: %s: %s" % (e.__class__.__name__, e))
+        self.log(imp, "Tuned index settings, replacing %s" % json.dumps(settings))
+        return settings
+
+    def restore_index(self, imp, settings):
+        try:
+            es_request('PUT', imp.index_url + '/_settings', {'index': settings})
+        except ES_ERRORS as e:
+            self.log(imp, "Restoring %s failed, restore them by hand" % json.dumps(settings))
+            raise RuntimeError("Restoring the index settings failed: %s: %s" %
+                               (e.__class__.__name__, e))
+        try:
+            os.remove(self.settings_path(imp))
+        except OSError as e:
+            raise RuntimeError("Removing the saved index settings failed: %s" % e)
+        self.log(imp, "Restored index settings")
+
+    def settings_path(self, imp):
+        index = urlparse.urlsplit(imp.index_url).path.strip('/')
+        return os.path.join(self.temp_dir, index + '.settings')
+
+    def refresh_index(self, imp):
+        try:
+            es_request('POST', imp.index_url + '/_refresh')
+        except ES_ERRORS as e:
+            raise RuntimeError("Refreshing the index failed: %s: %s" % (e.__class__.__name__, e))
+
+    def merge_index(self, imp):
+        self.log(imp, "Merging the index down to %d segments" % self.force_merge)
+        try:
+            es_request('POST', imp.index_url + '/_forcemerge?max_num_segments=%d' %
+                       self.force_merge)
+        except ES_ERRORS as e:
+            raise RuntimeError("Merging the index failed: %s: %s" % (e.__class__.__name__, e))
+
+
+def print_summary(imports, phases=('wait', 'download', 'import')):
+    row = "%-20s %-8s %8s %10s" + " %8s" * len(phases) + "  %s"
+    print(row % tuple(['wiki', 'status', 'size', 'docs'] + list(phases) + ['error']))
+    for imp in imports:
+        timings = ['%.0fs' % imp.timings[phase] if phase in imp.timings else '-'
+                   for phase in phases]
+        print(row % tuple([imp.wiki, imp.status, format_size(imp.size), imp.docs] + timings +
+                          [imp.error or '']))
+
+
+def print_throughput(imports):
+    print("%-20s %10s %8s %8s %10s %8s %8s %8s" %
+          ('wiki', 'docs/s', 'MB/s', 'requests', 'rejected', 'p50', 'p95', 'p99'))
+    for imp in imports:
+        if imp.indexer is None or not imp.timings.get('import'):
+            continue
+        elapsed = imp.timings['import']
+        latencies = ['%.2fs' % value if value is not None else '-'
+                     for value in (percentile(imp.indexer.latencies, p) for p in (50, 95, 99))]
+        print("%-20s %10.0f %8.1f %8d %10d %8s %8s %8s" %
+              tuple([imp.wiki, imp.indexer.acked / elapsed,
+                     imp.indexer.bytes_sent / elapsed / 1024 / 1024,
+                     len(imp.indexer.latencies), imp.indexer.rejected] + latencies))
+
+
 def main():
     parser = argparse.ArgumentParser(description='import wikimedia elasticsearch dumps',
                                      prog=sys.argv[0])
@@ -89,44 +1024,67 @@ def main():
                         help='date to load dump from')
     parser.add_argument('--temp-dir', dest='temp_dir', default='/tmp',
                         help='directory to download index into')
+    parser.add_argument('--max-downloads', dest='max_downloads', default=2, type=int,
+                        help='number of dumps to download at once')
+    parser.add_argument('--max-imports', dest='max_imports', default=1, type=int,
+                        help='number of dumps to import at once')
+    parser.add_argument('--disk-budget', dest='disk_budget', default=None, type=parse_size,
+                        help='maximum size of the dumps in the temp dir at once, e.g. 100G')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+                        help='import dumps while downloading them, without a temp file')
+    parser.add_argument('--batch-size', dest='batch_size', default='5M', type=parse_size,
+                        help='size of the bulk requests, e.g. 10M')
+    parser.add_argument('--concurrency', dest='concurrency', default=3, type=int,
+                        help='maximum number of concurrent bulk requests per import')
+    parser.add_argument('--resume', dest='resume', action='store_true',
+                        help='continue failed imports from their checkpoints in the temp dir')
+    parser.add_argument('--tune', dest='tune', action='store_true',
+                        help='disable refreshes and replicas of indices while importing into them')
+    parser.add_argument('--force-merge', dest='force_merge', default=None, type=int,
+                        help='merge indices down to this many segments after importing')
+    parser.add_argument('--stats', dest='stats', default=None,
+                        help='file to append the progress of the imports to, as JSON lines')
+    parser.add_argument('--stats-interval', dest='stats_interval', default=10, type=float,
+                        help='seconds between lines of stats')
     parser.add_argument('wikis', nargs='+', help='list of wikis to import')
     args = parser.parse_args()
 
     # Run some pre-checks that the import won't fail
+    imports = []
     for wiki in args.wikis:
         src_url = build_dump_url(wiki, args.date, args.type)
         dump_size = get_content_length(src_url)
-        check_disk_space(dump_size, args.temp_dir)
+        if not args.stream:
+            disk_needed = dump_size
+            partial = dump_path(args.temp_dir, src_url)
+            if args.resume and os.path.exists(partial):
+                disk_needed -= os.path.getsize(partial)
+            check_disk_space(disk_needed, args.temp_dir)
         check_index_exists(args.dest, wiki, args.type)
+        index_url = "http://%s:9200/%s_%s" % (args.dest, wiki, args.type)
+        imports.append(WikiImport(wiki, src_url, index_url, dump_size))
 
-    completed = []
-    failed = []
-    for wiki in args.wikis:
-        src_url = build_dump_url(wiki, args.date, args.type)
-        dump_size = get_content_length(src_url)
-        try:
-            check_disk_space(dump_size, args.temp_dir)
-        except RuntimeError as e:
-            # can't do this wiki, but keep trying the rest
-            print('Cannot download for %s, skipping: %s' % (wiki, e))
-            failed.append(wiki)
-            continue
-
-        fd, temp_path = tempfile.mkstemp(dir=args.temp_dir)
-        print("Downloading ", src_url, " to ", temp_path)
-        subprocess.Popen("curl -o %s %s" % (temp_path, src_url), shell=True).wait()
-        dest_url = "http://%s:9200/%s_%s/_bulk" % (args.dest, wiki, args.type)
-        cmd = 'curl -s %s --data-binary @- > /dev/null' % (dest_url)
-        subprocess.Popen("pv %s | zcat | parallel --pipe -L 100 -j3 '%s'" %
-                         (temp_path, cmd), shell=True).wait()
-        os.close(fd)
-        os.remove(temp_path)
-        completed.append(wiki)
+    scheduler = ImportScheduler(args.temp_dir, args.max_downloads, args.max_imports,
+                                args.disk_budget, args.stream, args.batch_size,
+                                args.concurrency, args.resume, args.tune, args.force_merge,
+                                args.stats, args.stats_interval)
+    phases = ['wait', 'download', 'import']
+    if args.tune:
+        phases += ['tune', 'restore', 'refresh']
+    if args.force_merge is not None:
+        phases.append('merge')
+    try:
+        scheduler.run(imports)
+    finally:
+        print_summary(imports, phases)
+        print_throughput(imports)
 
+    completed = [imp.wiki for imp in imports if imp.status == 'done']
+    failed = [imp.wiki for imp in imports if imp.status != 'done']
     if len(completed) > 0:
         print("Imported %d wikis: %s" % (len(completed), ', '.join(completed)))
     if len(failed) > 0:
-        print("Not enough disk space to import %d wikis: %s" % (len(failed), ', '.join(failed)))
+        print("Failed to import %d wikis: %s" % (len(failed), ', '.join(failed)))
 
 if __name__ == "__main__":
     main()
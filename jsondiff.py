@@ -9,9 +9,13 @@
 # or dissimilar values (arrays of single digit numbers, for example, can
 # cause confusion, because one 7 looks like every other 7).
 #
-# A smarter (future) version would intelligently diff the structure of
-# the JSON, but the goal here was to put something reasonable together
-# as quickly as possible.
+# With --output container the diffs are appended to a single data file
+# with an offset index, viewed through index.html, instead of one file
+# per line.
+#
+# With --mode structural it instead aligns the result rows of each pair
+# by pageId and reports rank moves, inserted and removed results, and
+# changed fields, as HTML plus one JSON record per pair in diffs.jsonl.
 #
 # It has a number of hacks specific to diffing JSON from CirrusSearch
 # results, including removing "searchmatch" markup and bolding elements
@@ -34,13 +38,20 @@
 # http://www.gnu.org/copyleft/gpl.html
 
 import argparse
+import cgi
 import difflib
+import fastjson
 import json
+import multiprocessing
 import os
 import re
 import sys
+import textwrap
+from collections import deque
 from itertools import izip_longest
-from jsonpath_rw import parse
+
+# searchmatch markup, as it appears in the raw JSON text
+SEARCHMATCH = re.compile(r'<span class=\\"searchmatch\\">(.*?)<\\/span>')
 
 
 def add_nums_to_results(results):
@@ -52,6 +63,19 @@ def add_nums_to_results(results):
     return results
 
 
+# Paths to the parts of a lucene explanation we care about, as sequences
+# of dict keys and list indexes. Add new paths here and use them from a
+# get_*_score function listed in SCORE_FIELDS.
+SCORE_PATHS = {
+    'main': ('value',),
+    'primary': ('details', 0, 'value'),
+    'primary_with_phrase': ('details', 0, 'details', 0, 'details', 0, 'value'),
+    'phrase': ('details', 0, 'details', 0, 'details', 1, 'value'),
+    'function': ('details', 0, 'value'),
+    'phrase_rescore': ('details', 0, 'details', 0, 'details', 1, 'details', 1, 'description'),
+}
+
+
 def munge_explanation(results):
     if 'rows' not in results:
         return {}
@@ -60,50 +84,469 @@ def munge_explanation(results):
             continue
         explanation = result['explanation']
         del result['explanation']
-        result['|scores'] = {
-            '1.main': get_main_score(explanation),
-            '2.primary': get_primary_score(explanation),
-            '3.phrase': get_phrase_score(explanation),
-            '4.function': get_function_score(explanation)
-        }
+        result['|scores'] = dict((field, get_score(explanation))
+                                 for (field, get_score) in SCORE_FIELDS)
 
 
 def get_main_score(exp):
-    return get_score_from_path(exp, parse('$.value'))
+    return get_score_from_path(exp, SCORE_PATHS['main'])
 
 
 def get_primary_score(exp):
-    primary = parse('$.details[0].value')
-    primary_with_phrase = parse('$.details[0].details[0].details[0].value')
     if has_phrase_rescore(exp):
-        return get_score_from_path(exp, primary_with_phrase)
+        return get_score_from_path(exp, SCORE_PATHS['primary_with_phrase'])
     else:
-        return get_score_from_path(exp, primary)
+        return get_score_from_path(exp, SCORE_PATHS['primary'])
 
 
 def get_phrase_score(exp):
-    phrase = parse('$.details[0].details[0].details[1].value')
     if has_phrase_rescore(exp):
-        return get_score_from_path(exp, phrase)
+        return get_score_from_path(exp, SCORE_PATHS['phrase'])
     else:
         return "N/A"
 
 
 def get_function_score(exp):
-    function = parse('$.details[0].value')
-    return get_score_from_path(exp, function)
+    return get_score_from_path(exp, SCORE_PATHS['function'])
 
 
 def get_score_from_path(exp, path):
-    score = path.find(exp)
-    if len(score) > 0:
-        return score[0].value
-    return "N/A"
+    for step in path:
+        try:
+            exp = exp[step]
+        except (KeyError, IndexError, TypeError):
+            return "N/A"
+    return exp
 
 
 def has_phrase_rescore(exp):
-    is_ph = parse('$.details[0].details[0].details[1].details[1].description').find(exp)
-    return len(is_ph) > 0 and is_ph[0].value == 'secondaryWeight'
+    return get_score_from_path(exp, SCORE_PATHS['phrase_rescore']) == 'secondaryWeight'
+
+
+# the scores shown in place of each result's explanation
+SCORE_FIELDS = [
+    ('1.main', get_main_score),
+    ('2.primary', get_primary_score),
+    ('3.phrase', get_phrase_score),
+    ('4.function', get_function_score),
+]
+
+
+def parse_line(line):
+    """Parse one line of a results file, after removing searchmatch markup."""
+    line = line.strip(' \t\n')
+    if line == '':
+        line = '{}'
+    return fastjson.loads(SEARCHMATCH.sub('\\1', line))
+
+
+def read_pairs(file1, file2, parse=parse_line):
+    """Yield (diff number, parsed line of file1, parsed line of file2) for
+    each pair of lines, numbered from 1.
+    """
+    with open(file1) as a, open(file2) as b:
+        for (diff_count, (aline, bline)) in enumerate(izip_longest(a, b, fillvalue='{}'), 1):
+            yield (diff_count, parse(aline), parse(bline))
+
+
+def make_stub(results, file1, file2):
+    """Return a short HTML page standing in for the diff of identical results."""
+    query = results.get('query', '') if isinstance(results, dict) else ''
+    output = textwrap.dedent(u"""\
+        <html>
+        <body>
+        <p><b><font color=#0000aa>query: {}</font></b></p>
+        <p>No differences between {} and {}.</p>
+        </body>
+        </html>
+        """).format(cgi.escape(query), cgi.escape(file1), cgi.escape(file2))
+    return output.encode('ascii', 'xmlcharrefreplace')
+
+
+def make_diff(aresults, bresults, file1, file2):
+    """Return an HTML diff of two parsed results, or None if they are
+    identical once normalized. This modifies both results.
+    """
+    if aresults == bresults:
+        return None  # no need to normalize
+
+    add_nums_to_results(aresults)
+    add_nums_to_results(bresults)
+
+    # munge lucene explanation
+    munge_explanation(aresults)
+    munge_explanation(bresults)
+
+    if aresults == bresults:
+        return None
+
+    aline = json.dumps(aresults, sort_keys=True, indent=2)
+    bline = json.dumps(bresults, sort_keys=True, indent=2)
+    output = difflib.HtmlDiff(wrapcolumn=50).make_file(aline.splitlines(),
+                                                       bline.splitlines(),
+                                                       file1, file2)
+    # highlight key fields
+    return re.sub(r'("(title|query|totalHits|relLabItemNumber)":&nbsp;.*?)</td>',
+                  '<b><font color=#0000aa>\\1</font></b></td>', output)
+
+
+def diff_fields(a, b, skip=()):
+    """Return {field: [a value, b value]} for the fields that differ between
+    dicts a and b. Nested dicts, like |scores, are compared field by field.
+    """
+    changed = {}
+    for key in set(a) | set(b):
+        if key in skip:
+            continue
+        (aval, bval) = (a.get(key), b.get(key))
+        if aval == bval:
+            continue
+        if isinstance(aval, dict) and isinstance(bval, dict):
+            for (subkey, vals) in diff_fields(aval, bval).items():
+                changed[key + '.' + subkey] = vals
+        else:
+            changed[key] = [aval, bval]
+    return changed
+
+
+def row_key(row, rank):
+    # results without a pageId can only be matched up by rank
+    return row.get('pageId', '#%d' % rank)
+
+
+def structural_diff(aresults, bresults):
+    """Align the result rows of two parsed results by pageId and return a
+    record of the changed top level fields and of every row, with its rank
+    in each result (None if missing) and changed fields. This takes time
+    linear in the size of the results.
+    """
+    arows = aresults.get('rows', [])
+    brows = bresults.get('rows', [])
+    record = {
+        'query': aresults.get('query', bresults.get('query', '')),
+        'fields': diff_fields(aresults, bresults, skip=('rows',)),
+        'rows': [],
+    }
+    aranks = {}
+    for (rank, row) in enumerate(arows, 1):
+        aranks.setdefault(row_key(row, rank), rank)
+    matched = set()
+    for (rank, row) in enumerate(brows, 1):
+        arank = aranks.get(row_key(row, rank))
+        fields = {}
+        if arank in matched:
+            arank = None  # duplicate result, the first copy was matched
+        elif arank is not None:
+            matched.add(arank)
+            fields = diff_fields(arows[arank - 1], row, skip=('relLabItemNumber',))
+        record['rows'].append({'pageId': row_key(row, rank), 'title': row.get('title', ''),
+                               'from': arank, 'to': rank, 'fields': fields})
+    for (rank, row) in enumerate(arows, 1):
+        if rank not in matched:
+            record['rows'].append({'pageId': row_key(row, rank), 'title': row.get('title', ''),
+                                   'from': rank, 'to': None, 'fields': {}})
+    return record
+
+
+def describe_move(row):
+    if row['from'] is None:
+        return 'new'
+    if row['to'] is None:
+        return 'removed'
+    if row['from'] > row['to']:
+        return '&uarr; %d' % (row['from'] - row['to'])
+    if row['from'] < row['to']:
+        return '&darr; %d' % (row['to'] - row['from'])
+    return ''
+
+
+def render_structural(record, file1, file2):
+    """Return an HTML page showing a structural diff record."""
+    def cell(value):
+        return cgi.escape(json.dumps(value))
+
+    output = textwrap.dedent(u"""\
+        <html>
+        <head>
+        <style>
+        td, th {{padding: 0 .5em; text-align: left; vertical-align: top}}
+        .new {{background: #aaffaa}}
+        .removed {{background: #ffaaaa}}
+        .moved {{background: #ffff77}}
+        </style>
+        </head>
+        <body>
+        <p><b><font color=#0000aa>query: {}</font></b></p>
+        <p>Baseline: {}<br>Delta: {}</p>
+        """).format(cgi.escape(record['query']), cgi.escape(file1), cgi.escape(file2))
+    if record['fields']:
+        output += u"<table>\n<tr><th>field</th><th>baseline</th><th>delta</th></tr>\n"
+        for (field, (aval, bval)) in sorted(record['fields'].items()):
+            output += u"<tr><td>{}</td><td>{}</td><td>{}</td></tr>\n".format(
+                cgi.escape(field), cell(aval), cell(bval))
+        output += u"</table>\n"
+    output += (u"<table>\n<tr><th>baseline</th><th>delta</th><th>move</th>"
+               u"<th>pageId</th><th>title</th><th>changes</th></tr>\n")
+    for row in record['rows']:
+        css = ''
+        if row['from'] is None:
+            css = 'new'
+        elif row['to'] is None:
+            css = 'removed'
+        elif row['from'] != row['to']:
+            css = 'moved'
+        changes = u"<br>".join(
+            u"{}: {} &rarr; {}".format(cgi.escape(field), cell(aval), cell(bval))
+            for (field, (aval, bval)) in sorted(row['fields'].items()))
+        output += u"<tr class='{}'><td>{}</td><td>{}</td><td>{}</td><td>{}</td>".format(
+            css, row['from'] or '', row['to'] or '', describe_move(row), cell(row['pageId']))
+        output += u"<td>{}</td><td>{}</td></tr>\n".format(cgi.escape(row['title']), changes)
+    output += u"</table>\n</body>\n</html>\n"
+    return output.encode('ascii', 'xmlcharrefreplace')
+
+
+def make_structural_diff(aresults, bresults, file1, file2):
+    """Return (HTML diff, diff record) for two parsed results; the HTML is
+    None if they are identical once normalized. This modifies both results.
+    """
+    if aresults != bresults:
+        munge_explanation(aresults)
+        munge_explanation(bresults)
+    record = structural_diff(aresults, bresults)
+    if aresults == bresults:
+        return (None, record)
+    return (render_structural(record, file1, file2), record)
+
+
+def write_diff(target_dir, diff_count, output):
+    with open(target_dir + 'diff' + repr(diff_count) + '.html', 'w') as diff_file:
+        diff_file.writelines(output)
+
+
+# Viewer for diffs in a DiffContainer. It loads the index once and then
+# fetches just the bytes of the requested diff with a Range request, so it
+# needs to be served over HTTP rather than opened as a local file.
+VIEWER = textwrap.dedent("""\
+    <html>
+    <head>
+    <style>
+    body {margin: 0}
+    iframe {border: 0; width: 100%; height: 100%}
+    </style>
+    <script>
+    var index = null;
+
+    function get(url, range, callback) {
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', url);
+        if (range) {
+            xhr.setRequestHeader('Range', 'bytes=' + range[0] + '-' + (range[0] + range[1] - 1));
+        }
+        xhr.onload = function () {
+            var text = xhr.responseText;
+            if (range && xhr.status == 200) {
+                // the server ignored the range and sent the whole file
+                text = text.substr(range[0], range[1]);
+            }
+            callback(text);
+        };
+        xhr.send();
+    }
+
+    function show() {
+        var num = window.location.hash.substring(1);
+        var frame = document.getElementById('diff');
+        if (!(num in index)) {
+            frame.srcdoc = 'No diff ' + num;
+            return;
+        }
+        get('diffs.dat', index[num], function (text) { frame.srcdoc = text; });
+    }
+
+    window.onload = function () {
+        get('diffs.idx', null, function (text) {
+            index = {};
+            var lines = text.split('\\n');
+            for (var i = 0; i < lines.length; i++) {
+                var fields = lines[i].split(' ');
+                if (fields.length == 3) {
+                    index[fields[0]] = [parseInt(fields[1]), parseInt(fields[2])];
+                }
+            }
+            show();
+        });
+    };
+    window.onhashchange = function () { if (index) { show(); } };
+    </script>
+    </head>
+    <body>
+    <iframe id="diff"></iframe>
+    </body>
+    </html>
+    """)
+
+
+class DiffContainer(object):
+    """All the diffs of a comparison in one append-only data file,
+    diffs.dat, with an index, diffs.idx, holding a "number offset length"
+    line per diff. index.html#N shows diff N.
+    """
+
+    def __init__(self, target_dir):
+        self.data = open(target_dir + 'diffs.dat', 'wb')
+        self.index = open(target_dir + 'diffs.idx', 'w')
+        self.offset = 0
+        with open(target_dir + 'index.html', 'w') as viewer:
+            viewer.write(VIEWER)
+
+    def add(self, diff_count, output):
+        if isinstance(output, unicode):
+            output = output.encode('ascii', 'xmlcharrefreplace')
+        self.data.write(output)
+        self.index.write('%d %d %d\n' % (diff_count, self.offset, len(output)))
+        self.offset += len(output)
+
+    def close(self):
+        self.data.close()
+        self.index.close()
+
+
+def write_diffs(target_dir, file1, file2, pairs, mode='text'):
+    """Diff and write a list of (diff number, aresults, bresults). Returns
+    the number of pairs that were identical, which only get a stub, the
+    list of diff records when mode is structural, and, when target_dir is
+    None, the list of (diff number, HTML diff) instead of writing them.
+    """
+    identical = 0
+    records = []
+    outputs = []
+    for (diff_count, aresults, bresults) in pairs:
+        if mode == 'structural':
+            (output, record) = make_structural_diff(aresults, bresults, file1, file2)
+            record['diff'] = diff_count
+            records.append(record)
+        else:
+            output = make_diff(aresults, bresults, file1, file2)
+        if output is None:
+            output = make_stub(aresults, file1, file2)
+            identical += 1
+        if target_dir is None:
+            outputs.append((diff_count, output))
+        else:
+            write_diff(target_dir, diff_count, output)
+    return (identical, records, outputs)
+
+
+class DiffWriter(object):
+    """Writes the diff of each pair of results. With jobs > 1 the pairs
+    are sent in chunks to a pool of worker processes, with a bounded number
+    of chunks in flight so memory use doesn't grow with the input.
+
+    Pairs that are identical, before or after normalization, get a stub
+    instead of a full diff; identical counts them. Whatever the number of
+    jobs, diffs are written in order.
+
+    mode is either 'text', for a line diff of the pretty printed JSON, or
+    'structural', for a diff of the aligned result rows that also writes
+    the diff records to diffs.jsonl, one JSON object per line.
+
+    output is either 'files', for one diffN.html per pair, or 'container',
+    to append them all to a DiffContainer.
+    """
+
+    def __init__(self, target_dir, file1, file2, jobs=1, chunk_size=20, mode='text',
+                 output='files'):
+        if mode not in ('text', 'structural'):
+            raise ValueError("Unknown diff mode %s" % mode)
+        if output not in ('files', 'container'):
+            raise ValueError("Unknown diff output %s" % output)
+        self.container = None
+        self.write_dir = target_dir
+        if output == 'container':
+            self.container = DiffContainer(target_dir)
+            # workers hand their diffs back to be appended to the container
+            self.write_dir = None
+        self.file1 = file1
+        self.file2 = file2
+        self.mode = mode
+        self.records = None
+        if mode == 'structural':
+            self.records = open(target_dir + 'diffs.jsonl', 'w')
+        self.chunk_size = chunk_size
+        self.chunk = []
+        self.ready = []  # results of identical pairs diffed along with the chunk
+        self.pending = deque()
+        self.jobs = jobs
+        self.pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        self.identical = 0
+
+    def add(self, diff_count, aresults, bresults):
+        """Diff a pair of parsed results. This modifies both results."""
+        pair = (diff_count, aresults, bresults)
+        if self.pool is None:
+            self.done(write_diffs(self.write_dir, self.file1, self.file2, [pair], self.mode))
+            return
+        if aresults == bresults:
+            # identical pairs are cheap, no need to hand them to the pool
+            self.ready.append(write_diffs(self.write_dir, self.file1, self.file2, [pair],
+                                          self.mode))
+        else:
+            self.chunk.append(pair)
+        if len(self.chunk) + len(self.ready) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.chunk and not self.ready:
+            return
+        while len(self.pending) >= 2 * self.jobs:
+            self.collect(self.pending.popleft())
+        result = None
+        if self.chunk:
+            result = self.pool.apply_async(
+                write_diffs, (self.write_dir, self.file1, self.file2, self.chunk, self.mode))
+        self.pending.append((result, self.ready))
+        self.chunk = []
+        self.ready = []
+
+    def collect(self, entry):
+        """Write the diffs of a chunk, in order with the identical pairs
+        that were diffed along with it.
+        """
+        (result, ready) = entry
+        if result is not None:
+            # get() re-raises errors from the worker
+            ready.append(result.get())
+        identical = sum(r[0] for r in ready)
+        records = sorted((record for r in ready for record in r[1]),
+                         key=lambda record: record['diff'])
+        outputs = sorted((output for r in ready for output in r[2]),
+                         key=lambda output: output[0])
+        self.done((identical, records, outputs))
+
+    def done(self, result):
+        (identical, records, outputs) = result
+        self.identical += identical
+        for record in records:
+            self.records.write(json.dumps(record, sort_keys=True) + '\n')
+        for (diff_count, output) in outputs:
+            self.container.add(diff_count, output)
+
+    def close(self):
+        if self.pool is not None:
+            self.flush()
+            while self.pending:
+                self.collect(self.pending.popleft())
+            self.pool.close()
+            self.pool.join()
+        if self.records is not None:
+            self.records.close()
+        if self.container is not None:
+            self.container.close()
+
+
+def prepare_dir(target_dir):
+    if not os.path.exists(target_dir):
+        os.makedirs(os.path.dirname(target_dir))
 
 
 def main():
@@ -112,51 +555,30 @@ def main():
     parser.add_argument('file', nargs=2, help='files to diff')
     parser.add_argument('-d', '--dir', dest='dir', default='./diffs/',
                         help='output directory, default is ./diffs/')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='number of worker processes generating diffs, default is 1')
+    parser.add_argument('-m', '--mode', dest='mode', default='text',
+                        choices=['text', 'structural'],
+                        help='text diff of the JSON, or structural diff of the aligned ' +
+                        'results plus diffs.jsonl records; default is text')
+    parser.add_argument('-o', '--output', dest='output', default='files',
+                        choices=['files', 'container'],
+                        help='one diffN.html file per pair, or a single container file ' +
+                        'viewed through index.html#N; default is files')
     args = parser.parse_args()
 
     (file1, file2) = args.file
     target_dir = args.dir + '/'
+    prepare_dir(target_dir)
 
+    writer = DiffWriter(target_dir, file1, file2, jobs=args.jobs, mode=args.mode,
+                        output=args.output)
     diff_count = 0
+    for (diff_count, aresults, bresults) in read_pairs(file1, file2):
+        writer.add(diff_count, aresults, bresults)
+    writer.close()
+    print('Skipped %d identical pairs out of %d' % (writer.identical, diff_count))
 
-    if not os.path.exists(target_dir):
-        os.makedirs(os.path.dirname(target_dir))
-
-    with open(file1) as a, open(file2) as b:
-        for tuple in izip_longest(a, b, fillvalue='{}'):
-            (aline, bline) = tuple
-            aline = aline.strip(' \t\n')
-            bline = bline.strip(' \t\n')
-            if aline == '':
-                aline = '{}'
-            if bline == '':
-                bline = '{}'
-            diff_count += 1
-            diff_file = open(target_dir + 'diff' + repr(diff_count) + '.html', 'w')
-
-            # remove searchmatch markup
-            aline = re.sub(r'<span class=\\"searchmatch\\">(.*?)<\\/span>',
-                           '\\1', aline)
-            bline = re.sub(r'<span class=\\"searchmatch\\">(.*?)<\\/span>',
-                           '\\1', bline)
-
-            aresults = add_nums_to_results(json.loads(aline))
-            bresults = add_nums_to_results(json.loads(bline))
-
-            # munge lucene explanation
-            munge_explanation(aresults)
-            munge_explanation(bresults)
-
-            aline = json.dumps(aresults, sort_keys=True, indent=2)
-            bline = json.dumps(bresults, sort_keys=True, indent=2)
-            output = difflib.HtmlDiff(wrapcolumn=50).make_file(aline.splitlines(),
-                                                               bline.splitlines(),
-                                                               file1, file2)
-            # highlight key fields
-            output = re.sub(r'("(title|query|totalHits|relLabItemNumber)":&nbsp;.*?)</td>',
-                            '<b><font color=#0000aa>\\1</font></b></td>', output)
-            diff_file.writelines(output)
-            diff_file.close()
 
 if __name__ == "__main__":
     main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-import json
+import fastjson
 import sys
 import requests
 import csv
@@ -46,7 +46,7 @@ def dumpReader(url, callback):
     l = 0
     for line in p.stdout:
         l += 1
-        page = json.loads(line)
+        page = fastjson.loads(line)
         if(l % 2 == 1):
             pageId = page['index']['_id']
             continue
@@ -22,14 +22,22 @@
 # read info from the .ini file to get names and maybe other info
 
 import argparse
+import fastjson
+import csv
+import inspect
 import json
+import multiprocessing
+import numpy
 import os
+import re
 import sys
 import textwrap
 
 from abc import ABCMeta, abstractmethod
+from collections import deque
+from heapq import heapify, heappush, heapreplace, nlargest
 from itertools import izip_longest
-from random import shuffle
+from random import random, seed, shuffle
 
 
 class Metric(object):
@@ -43,11 +51,16 @@ class Metric(object):
         delta_count: number of queries in the delta satisfying the metric
         b2d_diff: examples of metric present in baseline, absent in delta
         d2b_diff: examples of metric present in delta, absent in baseline (unsymmetric)
+        b2d_count: number of queries present in baseline, absent in delta
+        d2b_count: number of queries present in delta, absent in baseline
         symmetric: boolean indicating whether metric is symmetric
         printnum: max number of examples to print
-        printset: "random" or "ordered"--determines the order of examples printed
+        printset: "random" or "ordered"--determines which examples are printed
         raw_count: should output be raw_count rather than percent
         symbols: mnemonic symbols; [0] used for b2d or symmetric, [1] used for d2b
+        depth: number of top results whose pageIds the metric looks at
+        vectorized: whether batch_condition is implemented with array
+            operations on FeatureBatch features, rather than has_condition
 
     Non-symmetric metrics can be true of either the baseline or delta,
         both, or neither. An example is "zero results".
@@ -60,6 +73,9 @@ class Metric(object):
 
     __metaclass__ = ABCMeta
 
+    depth = 0
+    vectorized = False
+
     def __init__(self, name, symmetric=False, raw_count=False,
                  printset="random", printnum=20,
                  symbols=["&Delta;", "&Delta;"]):
@@ -70,10 +86,13 @@ class Metric(object):
         self.symbols = symbols
         self.b2d_diff = []
         self.d2b_diff = []
+        self.b2d_count = 0
+        self.d2b_count = 0
         self.raw_count = raw_count
         self.total_queries = 0
         self.baseline_count = 0
         self.delta_count = 0
+        self.intervals = {}
 
     def measure(self, baseline, delta, index):
         """Compares baseline json object to delta json object and
@@ -100,20 +119,154 @@ class Metric(object):
         if not self.symmetric and not baseline_is and delta_is:
             self.add_diff(baseline, delta, index, delta=True)
 
-    def add_diff(self, b, d, index, delta=False):
-        """Add example diff to b2d_diff (delta=False) or d2b_diff (delta=True)
+    def measure_batch(self, batch):
+        """Does the same bookkeeping as measure() for every pair in a
+           FeatureBatch at once. Returns the per-query values, as a dict of
+           "baseline" (and "delta" if not symmetric) arrays.
         """
+        self.total_queries += len(batch)
 
-        query_string = make_query_string(b, d)
+        baseline_is = self.batch_condition(batch)
+        self.baseline_count += int(baseline_is.sum())
 
-        if delta:
-            self.d2b_diff.append([index, query_string])
+        if self.symmetric:
+            delta_is = numpy.zeros(len(batch), dtype=bool)
         else:
-            self.b2d_diff.append([index, query_string])
+            delta_is = self.batch_condition(batch, reverse=True)
+            self.delta_count += int(delta_is.sum())
+
+        for i in numpy.flatnonzero(baseline_is & ~delta_is):
+            self.add_diff(batch.stubs[i][0], batch.stubs[i][1], int(batch.index[i]))
+
+        for i in numpy.flatnonzero(delta_is & ~baseline_is):
+            self.add_diff(batch.stubs[i][0], batch.stubs[i][1], int(batch.index[i]),
+                          delta=True)
+
+        if self.symmetric:
+            return {"baseline": baseline_is}
+        return {"baseline": baseline_is, "delta": delta_is}
+
+    def batch_condition(self, batch, reverse=False):
+        """Return a boolean array of has_condition(x, y) over the batch, with
+           x the baseline (or the delta if reverse). Subclasses that set
+           vectorized override this with array operations on the features.
+        """
+        pairs = batch.pairs
+        if reverse:
+            pairs = [(y, x) for (x, y) in pairs]
+        return numpy.array([bool(self.has_condition(x, y)) for (x, y) in pairs], dtype=bool)
+
+    def add_diff(self, b, d, index, delta=False, key=0):
+        """Add example diff to b2d_diff (delta=False) or d2b_diff (delta=True)
+
+        Only printnum examples are kept, as [sort key, index, query string]:
+        the first ones when printset is "ordered", a uniform random sample
+        when it is "random", or the ones with the lowest key when it is
+        "lowest". The last two keep the examples with the smallest keys
+        (random ones for "random") in a heap, with negated keys so the
+        largest is on top.
+        """
 
-    def results(self, what="diff"):
+        if delta:
+            self.d2b_count += 1
+            examples = self.d2b_diff
+            count = self.d2b_count
+        else:
+            self.b2d_count += 1
+            examples = self.b2d_diff
+            count = self.b2d_count
+
+        if self.printset == "random" or self.printset == "lowest":
+            key = -random() if self.printset == "random" else -key
+            if len(examples) < self.printnum:
+                heappush(examples, [key, index, make_query_string(b, d)])
+            elif examples and [key, index] > examples[0][0:2]:
+                heapreplace(examples, [key, index, make_query_string(b, d)])
+        elif len(examples) < self.printnum:
+            examples.append([count, index, make_query_string(b, d)])
+
+    def state(self):
+        """Returns the partial state of this metric, for another instance of
+           it that measured other queries to merge()
+        """
+        return {
+            "total_queries": self.total_queries,
+            "baseline_count": self.baseline_count,
+            "delta_count": self.delta_count,
+            "b2d_count": self.b2d_count,
+            "d2b_count": self.d2b_count,
+            "b2d_diff": self.b2d_diff,
+            "d2b_diff": self.d2b_diff,
+            }
+
+    def merge(self, state):
+        """Adds the state() of another instance of this metric, which measured
+           queries that come after the ones measured so far. The examples kept
+           are the same as if this instance had measured all the queries,
+           given the same random keys.
+        """
+        self.total_queries += state["total_queries"]
+        self.baseline_count += state["baseline_count"]
+        self.delta_count += state["delta_count"]
+        self.b2d_count += state["b2d_count"]
+        self.d2b_count += state["d2b_count"]
+        self.b2d_diff = self.merge_examples(self.b2d_diff, state["b2d_diff"])
+        self.d2b_diff = self.merge_examples(self.d2b_diff, state["d2b_diff"])
+
+    def merge_examples(self, examples, later):
+        if self.printset == "ordered":
+            # the first printnum, renumbered to be in order
+            merged = (examples + later)[0:self.printnum]
+            for (count, ex) in enumerate(merged, 1):
+                ex[0] = count
+            return merged
+        # the printnum lowest keys, which are negated
+        merged = nlargest(self.printnum, examples + later)
+        heapify(merged)
+        return merged
+
+    def changes(self):
+        """Returns the distinct values of the per-query change from baseline
+           to delta, in the units of results(), and how many queries have
+           each, for confidence intervals of the mean change
+        """
+        unchanged = self.total_queries - self.b2d_count - self.d2b_count
+        return (numpy.array([-100.0, 0.0, 100.0]),
+                numpy.array([self.b2d_count, unchanged, self.d2b_count]))
+
+    def interval(self, resamples, seed=0):
+        """Returns the 95% paired bootstrap confidence interval of the change
+           from baseline to delta, resampled with the given random seed, or
+           None if there is none. It is only computed once, so all outputs
+           show the same one.
+        """
+        if not resamples or self.symmetric or self.raw_count:
+            return None
+        if (resamples, seed) not in self.intervals:
+            (values, counts) = self.changes()
+            self.intervals[(resamples, seed)] = bootstrap(values, counts, resamples, seed=seed)
+        return self.intervals[(resamples, seed)]
+
+    def confidence(self, resamples, seed=0):
+        """Returns a string with the confidence interval of the change from
+           baseline to delta, marked with * if it doesn't include 0, or ""
+           if there is none
+        """
+        interval = self.interval(resamples, seed)
+        if interval is None:
+            return ""
+        (low, high) = interval
+        fmt = "{:+.3f}" if isinstance(self, GradedMetric) else "{:+.1f}%"
+        significant = "*" if low > 0 or high < 0 else ""
+        return (", 95% CI " + fmt + " to " + fmt + "{}").format(low, high, significant)
+
+    def results(self, what="diff", diff_link="diffs/diff{}.html", resamples=0, seed=0):
         """Returns a string with the metric results
             what: "baseline", "delta", or "diff", generates appropriate summary
+            diff_link: format string for the link to the diff of an example
+            resamples: number of bootstrap resamples for the confidence
+                interval of the delta, none if 0
+            seed: random seed of the bootstrap resamples
         """
 
         if what == "baseline" or what == "delta":
@@ -129,9 +282,8 @@ class Metric(object):
                     if not self.raw_count:
                         diff *= 100/float(self.total_queries)
                         diffstr += "%"
-                    diffstr += ")"
                     plus = "+" if diff > 0 else ""
-                    diffstr = diffstr.format(plus, diff)
+                    diffstr = diffstr.format(plus, diff) + self.confidence(resamples, seed) + ")"
             if self.raw_count:
                 ret_string += "<b>{}:</b> {}{}".format(self.name, count, diffstr)
             else:
@@ -145,37 +297,59 @@ class Metric(object):
         elif self.printnum > 0:  # diff
             ret_string = "<b>{}:</b>\n".format(self.name)
             ret_string += toggle_string()
-            printed = 0
-            if self.printset == "random":
-                # shuffle, unless all will be printed, then don't bother
-                if (len(self.b2d_diff) > self.printnum):
-                    shuffle(self.b2d_diff)
-                if (len(self.d2b_diff) > self.printnum):
-                    shuffle(self.d2b_diff)
-            for ex in self.b2d_diff:
-                ret_string += \
-                    u"&nbsp;&nbsp;{} <a href='diffs/diff{}.html'>{}</a><br>\n".format(
-                        self.symbols[0], ex[0], ex[1]
-                        )
-                printed += 1
-                if printed >= self.printnum:
-                    break
+            ret_string += self.examples(self.b2d_diff, self.symbols[0], diff_link)
             if not self.symmetric:
                 ret_string += "<br>\n"
-                printed = 0
-                for ex in self.d2b_diff:
-                    ret_string += \
-                        u"&nbsp;&nbsp;{} <a href='diffs/diff{}.html'>{}</a><br>\n".format(
-                            self.symbols[1], ex[0], ex[1]
-                            )
-                    printed += 1
-                    if printed >= self.printnum:
-                        break
+                ret_string += self.examples(self.d2b_diff, self.symbols[1], diff_link)
             ret_string += "</span>\n<br>\n"
             return ret_string.encode('ascii', 'xmlcharrefreplace')
 
         return ""
 
+    def ordered_examples(self, examples):
+        """Returns up to printnum of examples, in the order to show them"""
+        # sorting by key keeps ordered examples in order, puts random ones
+        # in random order, and the lowest ones lowest first (keys are negated)
+        return sorted(examples, reverse=(self.printset == "lowest"))[0:self.printnum]
+
+    def examples(self, examples, symbol, diff_link):
+        """Returns a string with up to printnum of examples, linked to their diffs"""
+        ret_string = u""
+        for ex in self.ordered_examples(examples):
+            ret_string += u"&nbsp;&nbsp;{} <a href='{}'>{}</a><br>\n".format(
+                symbol, diff_link.format(ex[1]), ex[2]
+                )
+        return ret_string
+
+    def summary(self, resamples=0, seed=0):
+        """Returns a dict summarizing the metric results, with the baseline
+           and delta values and their change as shown by results() (delta
+           and change are None for symmetric metrics), the confidence
+           interval of the change, if any, and the indexes of the examples
+        """
+        if self.raw_count:
+            (baseline, delta) = (self.baseline_count, self.delta_count)
+        else:
+            total = float(self.total_queries) if self.total_queries else 1.0
+            (baseline, delta) = (100 * self.baseline_count / total, 100 * self.delta_count / total)
+        summary = {
+            "name": self.name,
+            "type": self.__class__.__name__,
+            "symmetric": self.symmetric,
+            "queries": self.total_queries,
+            "baseline": baseline,
+            "delta": None if self.symmetric else delta,
+            "change": None if self.symmetric else delta - baseline,
+            "baseline_count": self.baseline_count,
+            "delta_count": None if self.symmetric else self.delta_count,
+            "b2d_count": self.b2d_count,
+            "d2b_count": None if self.symmetric else self.d2b_count,
+            "b2d_examples": [ex[1] for ex in self.ordered_examples(self.b2d_diff)],
+            "d2b_examples": [ex[1] for ex in self.ordered_examples(self.d2b_diff)],
+            }
+        summary.update(interval_summary(self.interval(resamples, seed)))
+        return summary
+
     @abstractmethod
     def has_condition(self, x, y):
         """Return true or false on whether the condition of the metric is satisfied."""
@@ -192,6 +366,8 @@ class ZeroResultsRate(Metric):
                                               symbols=["&darr;", "&uarr;"],
                                               printnum=printnum)
 
+    vectorized = True
+
     def has_condition(self, x, y):
         """Simple check: is totalHits == 0?
         """
@@ -199,6 +375,10 @@ class ZeroResultsRate(Metric):
             return x["totalHits"] == 0
         return 1  # empty JSON mean no hits
 
+    def batch_condition(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        return x.hits == 0  # empty JSON has 0 hits
+
 
 class TopNDiff(Metric):
     """Percentage of query pairs where the top N results DO NOT have the
@@ -207,10 +387,13 @@ class TopNDiff(Metric):
 
     __metaclass__ = ABCMeta
 
+    vectorized = True
+
     def __init__(self, topN=5, sorted=False, printnum=20):
         sortstr = "Sorted" if sorted else "Unsorted"
         self.sorted = sorted
         self.topN = topN
+        self.depth = topN
         super(TopNDiff, self).__init__("Top {} {} Results Differ".format(topN, sortstr),
                                        symmetric=True, printnum=printnum)
 
@@ -242,6 +425,28 @@ class TopNDiff(Metric):
 
         return 1
 
+    def batch_condition(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        x_len = numpy.minimum(x.rows, self.topN)
+        y_len = numpy.minimum(y.rows, self.topN)
+        # unused positions are -1 on both sides when the lengths match
+        x_ids = x.ids[:, :self.topN]
+        y_ids = y.ids[:, :self.topN]
+
+        if self.sorted:
+            same = (x_ids == y_ids).all(axis=1)
+        else:
+            # same sets: every valid id of each side is among the other's
+            x_valid = x_ids != -1
+            y_valid = y_ids != -1
+            found = (x_ids[:, :, None] == y_ids[:, None, :]) & \
+                x_valid[:, :, None] & y_valid[:, None, :]
+            same = (found.any(axis=2) | ~x_valid).all(axis=1) & \
+                (found.any(axis=1) | ~y_valid).all(axis=1)
+
+        no_hits = (x.hits == 0) & (y.hits == 0)  # no hits means no diff
+        return ~no_hits & ((x_len != y_len) | ~same)
+
 
 class QueryCount(Metric):
     """A count of queries in this query set."""
@@ -251,9 +456,523 @@ class QueryCount(Metric):
     def __init__(self):
         super(QueryCount, self).__init__("Query Count", raw_count=True, printnum=0)
 
+    vectorized = True
+
     def has_condition(self, x, y):
         return not len(x) == 0
 
+    def batch_condition(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        return x.nonempty
+
+
+class Accumulator(object):
+    """Running summary of a stream of scores, so that graded metrics don't
+       need to keep a score per query.
+
+    Attributes:
+        count: number of scores added
+        total: sum of the scores
+        histogram: number of scores in each of bins equal bins over low..high
+    """
+
+    def __init__(self, low=0.0, high=1.0, bins=10):
+        self.low = low
+        self.high = high
+        self.count = 0
+        self.total = 0.0
+        self.histogram = numpy.zeros(bins, dtype=numpy.int64)
+
+    def add(self, scores):
+        self.count += len(scores)
+        self.total += float(scores.sum())
+        self.histogram += numpy.histogram(scores, bins=len(self.histogram),
+                                          range=(self.low, self.high))[0]
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.histogram += other.histogram
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def distribution(self):
+        """Returns a string listing the number of scores in each bin"""
+        width = (self.high - self.low) / len(self.histogram)
+        return ", ".join("{:.1f}+ {}".format(self.low + i * width, n)
+                         for (i, n) in enumerate(self.histogram))
+
+
+class GradedMetric(Metric):
+    """A metric with a score per query rather than a yes/no condition.
+
+    Symmetric graded metrics score how similar the baseline and delta
+        results are, from 1 for the same results down; examples are the
+        queries with the lowest scores. Other graded metrics score the
+        baseline and delta separately; examples are the queries whose
+        score went down (b2d_diff) or up (d2b_diff) the most.
+
+    Only mean scores and histograms are kept, in Accumulators, along with
+        counts of the per-query changes from baseline to delta, rounded to
+        1/change_steps of the score range.
+
+    Attributes:
+        baseline_scores: Accumulator of baseline (or symmetric) scores
+        delta_scores: Accumulator of delta scores (non-symmetric)
+        change_counts: number of queries with each change (non-symmetric)
+    """
+
+    __metaclass__ = ABCMeta
+
+    vectorized = True
+    score_range = (0.0, 1.0)
+    # resolution of the per-query changes kept for confidence intervals
+    change_steps = 1000
+
+    def __init__(self, name, depth, symmetric=True, printnum=20,
+                 symbols=["&Delta;", "&Delta;"]):
+        super(GradedMetric, self).__init__(name, symmetric=symmetric, printset="lowest",
+                                           printnum=printnum, symbols=symbols)
+        self.depth = depth
+        self.baseline_scores = Accumulator(*self.score_range)
+        self.delta_scores = Accumulator(*self.score_range)
+        self.change_counts = numpy.zeros(2 * self.change_steps + 1, dtype=numpy.int64)
+
+    def measure(self, baseline, delta, index):
+        batch = FeatureBatch(self.depth)
+        batch.add(index, baseline, delta)
+        batch.finish()
+        self.measure_batch(batch)
+
+    def measure_batch(self, batch):
+        self.total_queries += len(batch)
+
+        (scores, scored) = self.scores(batch)
+        self.baseline_scores.add(scores[scored])
+
+        if self.symmetric:
+            for i in numpy.flatnonzero(scored & (scores < self.score_range[1])):
+                self.add_diff(batch.stubs[i][0], batch.stubs[i][1], int(batch.index[i]),
+                              key=scores[i])
+            return {"baseline": numpy.where(scored, scores, numpy.nan)}
+
+        (delta_scores, delta_scored) = self.scores(batch, reverse=True)
+        self.delta_scores.add(delta_scores[delta_scored])
+
+        change = numpy.where(scored & delta_scored, delta_scores - scores, 0)
+        step = (self.score_range[1] - self.score_range[0]) / self.change_steps
+        steps = numpy.rint(change[scored & delta_scored] / step).astype(numpy.int64)
+        self.change_counts += numpy.bincount(steps + self.change_steps,
+                                             minlength=len(self.change_counts))
+        for i in numpy.flatnonzero(change < 0):
+            self.add_diff(batch.stubs[i][0], batch.stubs[i][1], int(batch.index[i]),
+                          key=change[i])
+        for i in numpy.flatnonzero(change > 0):
+            self.add_diff(batch.stubs[i][0], batch.stubs[i][1], int(batch.index[i]),
+                          delta=True, key=-change[i])
+
+        return {"baseline": numpy.where(scored, scores, numpy.nan),
+                "delta": numpy.where(delta_scored, delta_scores, numpy.nan)}
+
+    def state(self):
+        state = super(GradedMetric, self).state()
+        state["baseline_scores"] = self.baseline_scores
+        state["delta_scores"] = self.delta_scores
+        state["change_counts"] = self.change_counts
+        return state
+
+    def merge(self, state):
+        super(GradedMetric, self).merge(state)
+        self.baseline_scores.merge(state["baseline_scores"])
+        self.delta_scores.merge(state["delta_scores"])
+        self.change_counts += state["change_counts"]
+
+    def summary(self, resamples=0, seed=0):
+        summary = super(GradedMetric, self).summary()
+        (baseline, delta) = (self.baseline_scores.mean(), self.delta_scores.mean())
+        summary.update({
+            "baseline": baseline,
+            "baseline_scored": self.baseline_scores.count,
+            "baseline_histogram": self.baseline_scores.histogram.tolist(),
+            "histogram_range": [self.baseline_scores.low, self.baseline_scores.high],
+            })
+        del summary["baseline_count"]
+        del summary["delta_count"]
+        if not self.symmetric:
+            summary.update({
+                "delta": delta,
+                "change": None if baseline is None or delta is None else delta - baseline,
+                "delta_scored": self.delta_scores.count,
+                "delta_histogram": self.delta_scores.histogram.tolist(),
+                })
+        summary.update(interval_summary(self.interval(resamples, seed)))
+        return summary
+
+    def changes(self):
+        width = self.score_range[1] - self.score_range[0]
+        return (numpy.linspace(-width, width, len(self.change_counts)), self.change_counts)
+
+    @abstractmethod
+    def scores(self, batch, reverse=False):
+        """Return an array of scores for the batch, with x the baseline (or
+           the delta if reverse), and a boolean array of which queries have
+           a score.
+        """
+        pass
+
+    def score(self, x, y):
+        """Returns the score of x against y for a single pair, or None if
+           the pair is not scored
+        """
+        batch = FeatureBatch(self.depth)
+        batch.add(0, x, y)
+        batch.finish()
+        (scores, scored) = self.scores(batch)
+        return float(scores[0]) if scored[0] else None
+
+    def has_condition(self, x, y):
+        """Whether the pair is an example of the metric, as in measure_batch():
+           for symmetric metrics, x scores below the best against y; for
+           others, y scores below x.
+        """
+        x_score = self.score(x, y)
+        if x_score is None:
+            return False
+        if self.symmetric:
+            return x_score < self.score_range[1]
+        y_score = self.score(y, x)
+        return y_score is not None and y_score < x_score
+
+    def results(self, what="diff", diff_link="diffs/diff{}.html", resamples=0, seed=0):
+        """Returns a string with the mean scores for "baseline" or "delta",
+           or the score distribution and the examples for "diff"
+        """
+        if what == "baseline" or what == "delta":
+            if what == "delta" and self.symmetric:
+                what = "baseline"
+            scores = self.baseline_scores if what == "baseline" else self.delta_scores
+            mean = scores.mean()
+            meanstr = "n/a" if mean is None else "{:.3f}".format(mean)
+            diffstr = ""
+            if what == "delta" and mean is not None and self.baseline_scores.count:
+                diff = mean - self.baseline_scores.mean()
+                if abs(diff) >= 0.0005:
+                    diffstr = " ({:+.3f}{})".format(diff, self.confidence(resamples, seed))
+            return "&nbsp;&nbsp; <b>{}:</b> {}{} ({} queries)<br>\n".format(
+                self.name, meanstr, diffstr, scores.count)
+
+        elif self.printnum > 0:  # diff
+            ret_string = "<b>{}:</b>\n".format(self.name)
+            ret_string += toggle_string()
+            if self.symmetric:
+                ret_string += "&nbsp;&nbsp; <i>Distribution: {}</i><br>\n".format(
+                    self.baseline_scores.distribution())
+            else:
+                ret_string += "&nbsp;&nbsp; <i>Baseline distribution: {}</i><br>\n".format(
+                    self.baseline_scores.distribution())
+                ret_string += "&nbsp;&nbsp; <i>Delta distribution: {}</i><br>\n".format(
+                    self.delta_scores.distribution())
+            ret_string += self.examples(self.b2d_diff, self.symbols[0], diff_link)
+            if not self.symmetric:
+                ret_string += "<br>\n"
+                ret_string += self.examples(self.d2b_diff, self.symbols[1], diff_link)
+            ret_string += "</span>\n<br>\n"
+            return ret_string.encode('ascii', 'xmlcharrefreplace')
+
+        return ""
+
+
+def match_matrix(x, y, depth):
+    """Returns a (queries, depth, depth) boolean array, true where result i
+       of x is result j of y. Repeated pageIds only match once.
+    """
+    return (x.ids[:, :depth, None] == y.ids[:, None, :depth]) & \
+        x.unique[:, :depth, None] & y.unique[:, None, :depth]
+
+
+def both_empty(x, y, depth):
+    """Returns a boolean array, true where neither x nor y have results"""
+    return ~x.unique[:, :depth].any(axis=1) & ~y.unique[:, :depth].any(axis=1)
+
+
+class RankBiasedOverlap(GradedMetric):
+    """Rank-biased overlap of the top depth results: the overlap at each
+       depth d, weighted by p^(d-1), so that differences near the top count
+       the most, extrapolated past depth. Lists shorter than depth are
+       compared as if they were complete. Queries without results on
+       either side are not scored.
+    """
+
+    def __init__(self, depth=10, p=0.9, printnum=20):
+        super(RankBiasedOverlap, self).__init__("RBO@{} (p={})".format(depth, p), depth,
+                                                printnum=printnum)
+        self.p = p
+
+    def scores(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        k = self.depth
+        # overlap of the top d results, for d = 1..k
+        overlap = numpy.diagonal(match_matrix(x, y, k).cumsum(1).cumsum(2), axis1=1, axis2=2)
+        length = numpy.maximum(x.unique[:, :k].sum(1), y.unique[:, :k].sum(1))
+        d = numpy.arange(1, k + 1)
+        agreement = overlap / numpy.maximum(numpy.minimum(d, length[:, None]), 1).astype(float)
+        weights = (1 - self.p) * self.p ** (d - 1)
+        scores = (agreement * weights).sum(1) + self.p ** k * agreement[:, -1]
+        return (scores, ~both_empty(x, y, k))
+
+
+class JaccardAtK(GradedMetric):
+    """Jaccard similarity of the sets of top depth pageIds. Queries without
+       results on either side are not scored.
+    """
+
+    def __init__(self, depth=10, printnum=20):
+        super(JaccardAtK, self).__init__("Jaccard@{}".format(depth), depth,
+                                         printnum=printnum)
+
+    def scores(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        k = self.depth
+        shared = match_matrix(x, y, k).sum((1, 2))
+        union = x.unique[:, :k].sum(1) + y.unique[:, :k].sum(1) - shared
+        return (shared / numpy.maximum(union, 1).astype(float), union > 0)
+
+
+class KendallTau(GradedMetric):
+    """Kendall tau between the baseline and delta orders of the pageIds
+       found in both top depth results. Queries with fewer than two shared
+       pageIds are not scored.
+    """
+
+    score_range = (-1.0, 1.0)
+
+    def __init__(self, depth=10, printnum=20):
+        super(KendallTau, self).__init__("Kendall Tau@{}".format(depth), depth,
+                                         printnum=printnum)
+
+    def scores(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        k = self.depth
+        matches = match_matrix(x, y, k)
+        shared = matches.any(2)
+        position = matches.argmax(2)  # position in y of result i of x
+        pairs = shared[:, :, None] & shared[:, None, :] & numpy.triu(numpy.ones((k, k), bool), 1)
+        concordant = (pairs & (position[:, :, None] < position[:, None, :])).sum((1, 2))
+        discordant = (pairs & (position[:, :, None] > position[:, None, :])).sum((1, 2))
+        total = concordant + discordant
+        return ((concordant - discordant) / numpy.maximum(total, 1).astype(float), total > 0)
+
+
+class Judgments(object):
+    """Graded relevance judgments, read from a tab-separated file with a
+       query, pageId, grade line per judgment. Blank lines and lines
+       starting with # are ignored.
+
+    Attributes:
+        grades: dict of pageId to grade dicts, by query
+        max_grade: highest grade in the file
+    """
+
+    def __init__(self, filename):
+        self.grades = {}
+        self.max_grade = 0.0
+        with open(filename) as f:
+            for line in f:
+                if line.strip() == "" or line.startswith("#"):
+                    continue
+                (query, page_id, grade) = line.rstrip("\r\n").split("\t")
+                grade = float(grade)
+                self.grades.setdefault(query.decode("utf-8"), {})[int(page_id)] = grade
+                self.max_grade = max(self.max_grade, grade)
+
+    def batch_grades(self, queries, ids):
+        """Returns a (queries, depth) array of the grades of the results in
+           ids, 0 for results without a judgment
+        """
+        return numpy.array([[self.grades.get(q, {}).get(page_id, 0.0) for page_id in row]
+                            for (q, row) in zip(queries, ids.tolist())],
+                           dtype=float).reshape(ids.shape)
+
+    def ideal_grades(self, queries, depth):
+        """Returns a (queries, depth) array of the best possible grades"""
+        ideal = []
+        for q in queries:
+            grades = sorted(self.grades.get(q, {}).values(), reverse=True)[0:depth]
+            ideal.append(grades + [0.0] * (depth - len(grades)))
+        return numpy.array(ideal, dtype=float).reshape(len(queries), depth)
+
+
+class JudgedMetric(GradedMetric):
+    """A graded metric scoring the baseline and delta results separately
+       against relevance judgments. Results without a judgment have grade 0,
+       and queries without judgments are not scored.
+    """
+
+    __metaclass__ = ABCMeta
+
+    def __init__(self, name, depth, judgments, printnum=20):
+        super(JudgedMetric, self).__init__(name, depth, symmetric=False, printnum=printnum,
+                                           symbols=["&darr;", "&uarr;"])
+        self.judgments = judgments
+
+    def scores(self, batch, reverse=False):
+        (x, y) = batch.sides(reverse)
+        queries = [stubs[0].get("query") for stubs in batch.stubs]
+        grades = self.judgments.batch_grades(queries, x.ids[:, :self.depth])
+        grades[~x.unique[:, :self.depth]] = 0.0  # repeated results don't count twice
+        return self.grade_scores(grades, queries)
+
+    @abstractmethod
+    def grade_scores(self, grades, queries):
+        """Return scores for the (queries, depth) array of grades, and a
+           boolean array of which queries have a score.
+        """
+        pass
+
+
+class NDCG(JudgedMetric):
+    """Normalized discounted cumulative gain of the top depth results."""
+
+    def __init__(self, depth=10, judgments=None, printnum=20):
+        super(NDCG, self).__init__("NDCG@{}".format(depth), depth, judgments, printnum=printnum)
+
+    def grade_scores(self, grades, queries):
+        discount = 1 / numpy.log2(numpy.arange(2, self.depth + 2))
+        dcg = ((2 ** grades - 1) * discount).sum(1)
+        ideal = self.judgments.ideal_grades(queries, self.depth)
+        idcg = ((2 ** ideal - 1) * discount).sum(1)
+        return (dcg / numpy.where(idcg > 0, idcg, 1), idcg > 0)
+
+
+class ERR(JudgedMetric):
+    """Expected reciprocal rank of the top depth results, with the
+       probability of each result satisfying the user given by its grade
+    """
+
+    def __init__(self, depth=10, judgments=None, printnum=20):
+        super(ERR, self).__init__("ERR@{}".format(depth), depth, judgments, printnum=printnum)
+
+    def grade_scores(self, grades, queries):
+        satisfied = (2 ** grades - 1) / 2 ** self.judgments.max_grade
+        # probability of getting to each rank without being satisfied first
+        reached = numpy.cumprod(1 - satisfied, axis=1)
+        reached = numpy.hstack([numpy.ones((len(grades), 1)), reached[:, :-1]])
+        scores = (satisfied * reached / numpy.arange(1, self.depth + 1)).sum(1)
+        return (scores, numpy.array([q in self.judgments.grades for q in queries], dtype=bool))
+
+
+class Features(object):
+    """Per-query features of one side of a FeatureBatch, as arrays.
+
+    Attributes:
+        hits: totalHits, 0 if missing
+        rows: number of result rows
+        nonempty: whether the results JSON was not empty
+        ids: pageIds of the top depth results, shape (queries, depth),
+            padded with -1
+        unique: whether each of ids is a result, and not a repeat of an
+            earlier pageId
+    """
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.hits = []
+        self.rows = []
+        self.nonempty = []
+        self.ids = []
+
+    def add(self, results):
+        rows = results.get("rows", [])
+        self.hits.append(results.get("totalHits", 0))
+        self.rows.append(len(rows))
+        self.nonempty.append(len(results) != 0)
+        ids = [r.get("pageId", -2) for r in rows[0:self.depth]]
+        self.ids.append(ids + [-1] * (self.depth - len(ids)))
+
+    def finish(self):
+        self.hits = numpy.array(self.hits, dtype=numpy.int64)
+        self.rows = numpy.array(self.rows, dtype=numpy.int64)
+        self.nonempty = numpy.array(self.nonempty, dtype=bool)
+        self.ids = numpy.array(self.ids, dtype=numpy.int64).reshape(len(self.rows), self.depth)
+        earlier = numpy.tril(numpy.ones((self.depth, self.depth), bool), -1)
+        repeat = ((self.ids[:, :, None] == self.ids[:, None, :]) & earlier).any(2)
+        self.unique = (self.ids != -1) & ~repeat
+
+
+class FeatureBatch(object):
+    """A batch of query pairs, with the features the metrics need extracted
+       once into columnar arrays so every metric can be computed with a few
+       array operations.
+
+    Attributes:
+        a: Features of the baseline results
+        b: Features of the delta results
+        index: array of the index of each pair
+        stubs: ({"query": ...}, {"query": ...}) for each pair, to make
+            example query strings from
+        pairs: the parsed (baseline, delta) pairs, only kept if keep_pairs
+            is set, for metrics that aren't vectorized
+    """
+
+    def __init__(self, depth, keep_pairs=False):
+        self.a = Features(depth)
+        self.b = Features(depth)
+        self.index = []
+        self.stubs = []
+        self.pairs = [] if keep_pairs else None
+
+    def __len__(self):
+        return len(self.index)
+
+    def add(self, index, ajson, bjson):
+        self.index.append(index)
+        self.a.add(ajson)
+        self.b.add(bjson)
+        self.stubs.append((query_stub(ajson), query_stub(bjson)))
+        if self.pairs is not None:
+            self.pairs.append((ajson, bjson))
+
+    def finish(self):
+        self.index = numpy.array(self.index, dtype=numpy.int64)
+        self.a.finish()
+        self.b.finish()
+
+    def sides(self, reverse=False):
+        """Return (x, y) features, with x the baseline unless reverse."""
+        return (self.b, self.a) if reverse else (self.a, self.b)
+
+
+def query_stub(results):
+    return {"query": results["query"]} if "query" in results else {}
+
+
+def interval_summary(interval):
+    """Returns the summary() entries for a confidence interval"""
+    if interval is None:
+        return {"ci_low": None, "ci_high": None, "significant": None}
+    (low, high) = interval
+    return {"ci_low": low, "ci_high": high, "significant": bool(low > 0 or high < 0)}
+
+
+def bootstrap(values, counts, resamples, level=0.95, seed=0):
+    """Returns the percentile bootstrap confidence interval of the mean of
+       a sample given as distinct values and the count of each. Resampling
+       a sample amounts to drawing new counts from a multinomial, so this
+       takes time in the number of distinct values, not the sample size.
+       The same seed gives the same interval.
+    """
+    total = counts.sum()
+    if total == 0:
+        return (0.0, 0.0)
+    used = counts > 0
+    (values, counts) = (values[used], counts[used])
+    random_state = numpy.random.RandomState(seed)
+    samples = random_state.multinomial(total, counts / float(total), size=resamples)
+    means = samples.dot(values) / float(total)
+    tail = 100 * (1 - level) / 2
+    return tuple(numpy.percentile(means, [tail, 100 - tail]))
+
 
 def make_query_string(x, y):
         query_string = x_query = y_query = ""
@@ -274,7 +993,8 @@ def make_query_string(x, y):
         return query_string
 
 
-def print_report(target_dir, diff_count, file1, file2, myMetrics, errors):
+def print_report(target_dir, diff_count, file1, file2, myMetrics, errors,
+                 diff_link="diffs/diff{}.html", resamples=0, seed=0):
     report_file = open(target_dir + "report.html", "w")
     report_file.write(textwrap.dedent("""\
         <script>
@@ -301,6 +1021,11 @@ def print_report(target_dir, diff_count, file1, file2, myMetrics, errors):
         <b>Stats:</b> {} query pairs compared<br>
         """).format(target_dir, diff_count))
 
+    if resamples:
+        report_file.write("<b>Confidence intervals:</b> paired bootstrap with {} resamples "
+                          "(seed {}); * marks changes whose interval doesn't include 0<br>\n".
+                          format(resamples, seed))
+
     if len(errors):
         report_file.write("<br>\n<font color=red><b>QUERY PAIRS WITH ERRORS: " +
                           "{}</b></font>\n".format(len(errors)))
@@ -310,8 +1035,9 @@ def print_report(target_dir, diff_count, file1, file2, myMetrics, errors):
         shuffle(keylist)
         for e in keylist:
             report_file.write("&nbsp;&nbsp; <font color=red>ERROR</font> " +
-                              "<a href='diffs/diff{}.html'>{}</a><br>\n".
-                              format(e, errors[e].encode('ascii', 'xmlcharrefreplace')))
+                              "<a href='{}'>{}</a><br>\n".
+                              format(diff_link.format(e),
+                                     errors[e].encode('ascii', 'xmlcharrefreplace')))
             printed += 1
             if printed >= 50:
                 break
@@ -337,7 +1063,7 @@ def print_report(target_dir, diff_count, file1, file2, myMetrics, errors):
         """).format(file2))
 
     for m in myMetrics:
-        report_file.write(m.results("delta"))
+        report_file.write(m.results("delta", resamples=resamples, seed=seed))
 
     report_file.write(textwrap.dedent("""\
         </blockquote>
@@ -347,7 +1073,7 @@ def print_report(target_dir, diff_count, file1, file2, myMetrics, errors):
         """))
 
     for m in myMetrics:
-        report_file.write(m.results())
+        report_file.write(m.results(diff_link=diff_link))
 
     report_file.write("</blockquote>")
 
@@ -359,6 +1085,289 @@ def toggle_string():
 toggle_string.num = 0
 
 
+def parse_line(line):
+    """Parse one line of a results file; blank lines are empty results."""
+    line = line.strip(" \t\n")
+    if line == "":
+        line = "{}"
+    return fastjson.loads(line)
+
+
+# metric types, by the name used to configure them
+METRICS = {
+    'queryCount': QueryCount,
+    'zeroResults': ZeroResultsRate,
+    'topN': TopNDiff,
+    'rbo': RankBiasedOverlap,
+    'jaccard': JaccardAtK,
+    'kendallTau': KendallTau,
+    'ndcg': NDCG,
+    'err': ERR,
+    }
+
+DEFAULT_METRICS = """
+    queryCount
+    zeroResults
+    topN topN=3 sorted=false
+    topN topN=3 sorted=true
+    topN topN=5 sorted=false
+    topN topN=5 sorted=true
+    """
+
+JUDGED_METRICS = """
+    ndcg depth=10
+    err depth=10
+    """
+
+
+def parse_value(value):
+    """Parse a metric parameter as a bool, int or float, if it is one"""
+    if value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def parse_metrics(spec, printnum=20, judgments=None):
+    """Return the metrics configured by spec: one metric per line (or comma
+       separated), as a type from METRICS followed by its constructor
+       parameters as name=value, e.g. "topN topN=10 sorted=true printnum=50".
+       printnum and judgments are passed to the metrics that take them,
+       unless given.
+    """
+    metrics = []
+    for line in spec.replace(",", "\n").splitlines():
+        words = line.split()
+        if not words:
+            continue
+        if words[0] not in METRICS:
+            raise ValueError("Unknown metric type %s, should be one of %s" %
+                             (words[0], ", ".join(sorted(METRICS))))
+        metric = METRICS[words[0]]
+        args = inspect.getargspec(metric.__init__).args
+        params = {}
+        for word in words[1:]:
+            (name, sep, value) = word.partition("=")
+            if not sep or name not in args or name in ("self", "judgments"):
+                raise ValueError("Bad parameter %s for metric %s" % (word, words[0]))
+            params[name] = parse_value(value)
+        if "printnum" in args:
+            params.setdefault("printnum", printnum)
+        if "judgments" in args:
+            if judgments is None:
+                raise ValueError("Metric %s needs judgments" % words[0])
+            params["judgments"] = judgments
+        metrics.append(metric(**params))
+    return metrics
+
+
+def default_spec(judged=False):
+    """Returns the spec of the default metrics, with NDCG and ERR if judged"""
+    return DEFAULT_METRICS + JUDGED_METRICS if judged else DEFAULT_METRICS
+
+
+def default_metrics(printnum=20, judgments=None):
+    """judgments: Judgments to add NDCG and ERR metrics for, if any"""
+    return parse_metrics(default_spec(judgments is not None), printnum, judgments)
+
+
+class Comparison(object):
+    """Measures pairs of parsed results with a list of metrics, a
+       FeatureBatch of batch_size pairs at a time.
+
+    Attributes:
+        metrics: the Metrics to compute
+        errors: query strings of the pairs with errors, by index
+        diff_count: number of pairs added
+        columns: if features is set, per-query columns for feature_columns(),
+            as lists of arrays by column name
+    """
+
+    def __init__(self, metrics, batch_size=1000, features=False):
+        self.metrics = metrics
+        self.errors = {}
+        self.diff_count = 0
+        self.batch_size = batch_size
+        self.depth = max([m.depth for m in metrics] + [0])
+        self.keep_pairs = not all(m.vectorized for m in metrics)
+        self.batch = FeatureBatch(self.depth, self.keep_pairs)
+        self.columns = {} if features else None
+
+    def add(self, index, ajson, bjson):
+        """Measure one pair of parsed results, or record it as an error."""
+        self.diff_count += 1
+        if 'error' in ajson or 'error' in bjson:
+            self.errors[index] = make_query_string(ajson, bjson)
+            return
+        self.batch.add(index, ajson, bjson)
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.batch) == 0:
+            return
+        self.batch.finish()
+        columns = {
+            "index": self.batch.index,
+            "baseline.totalHits": self.batch.a.hits,
+            "delta.totalHits": self.batch.b.hits,
+            "baseline.rows": self.batch.a.rows,
+            "delta.rows": self.batch.b.rows,
+            }
+        for m in self.metrics:
+            values = m.measure_batch(self.batch)
+            for (side, column) in values.items():
+                columns[column_name(m) + "." + side] = column
+        if self.columns is not None:
+            for (name, column) in columns.items():
+                self.columns.setdefault(name, []).append(column)
+        self.batch = FeatureBatch(self.depth, self.keep_pairs)
+
+    def feature_columns(self):
+        """Returns the per-query columns of the measured pairs, as arrays
+           by column name
+        """
+        return dict((name, numpy.concatenate(column)) for (name, column) in self.columns.items())
+
+
+def column_name(metric):
+    """Returns a name for the per-query feature columns of metric"""
+    return re.sub("[^0-9a-z]+", "_", metric.name.lower()).strip("_")
+
+
+def write_summary(target_dir, diff_count, file1, file2, myMetrics, errors, resamples=0,
+                  seed=0):
+    """Write summary.json with the summary() of each metric, and
+       summary.csv with one row of the main values per metric
+    """
+    summaries = [m.summary(resamples, seed) for m in myMetrics]
+    with open(target_dir + "summary.json", "w") as f:
+        json.dump({
+            "baseline": file1,
+            "delta": file2,
+            "pairs": diff_count,
+            "errors": sorted(errors.keys()),
+            "resamples": resamples,
+            "seed": seed,
+            "metrics": summaries,
+            }, f, indent=2, sort_keys=True)
+        f.write("\n")
+    fields = ["name", "type", "queries", "baseline", "delta", "change",
+              "ci_low", "ci_high", "significant"]
+    with open(target_dir + "summary.csv", "w") as f:
+        summary_csv = csv.writer(f)
+        summary_csv.writerow(fields)
+        for summary in summaries:
+            summary_csv.writerow(["" if summary[field] is None else summary[field]
+                                  for field in fields])
+
+
+def write_features(target_dir, columns):
+    """Write the per-query feature columns to features.npz (see numpy.load)"""
+    numpy.savez_compressed(target_dir + "features.npz", **columns)
+
+
+def chunk_offsets(file1, file2, chunk_size):
+    """Yield (first pair number, offset in file1, offset in file2, number of
+       pairs) for line-aligned chunks of chunk_size pairs of lines, numbered
+       from 1. The shorter file is padded with empty lines.
+    """
+    with open(file1) as a, open(file2) as b:
+        first = 1
+        while True:
+            (offset1, offset2) = (a.tell(), b.tell())
+            count = 0
+            while count < chunk_size:
+                (aline, bline) = (a.readline(), b.readline())
+                if not aline and not bline:
+                    break
+                count += 1
+            if count == 0:
+                return
+            yield (first, offset1, offset2, count)
+            first += count
+
+
+# what the measure_parallel() worker process measures, see init_worker()
+worker = None
+
+
+def init_worker(file1, file2, spec, printnum, judgments_file, features):
+    """Set up a measure_parallel() worker process to measure chunks of
+       file1 and file2 with metrics from spec, loading the judgments once
+    """
+    global worker
+    seed()  # pool workers are forked with the same random state
+    judgments = Judgments(judgments_file) if judgments_file else None
+    worker = (file1, file2, spec, printnum, judgments, features)
+
+
+def measure_chunk(chunk):
+    """Measure a chunk of pairs from chunk_offsets() with new metrics, in a
+       worker set up by init_worker(). Returns the state() of each metric,
+       the errors, the number of pairs, and the per-query feature columns
+       if features is set.
+    """
+    (file1, file2, spec, printnum, judgments, features) = worker
+    (first, offset1, offset2, count) = chunk
+    comparison = Comparison(parse_metrics(spec, printnum, judgments), features=features)
+    # vectorized metrics only need the fields extract_results decodes
+    parse = parse_line if comparison.keep_pairs else fastjson.extract_results
+    with open(file1) as a, open(file2) as b:
+        a.seek(offset1)
+        b.seek(offset2)
+        for index in xrange(first, first + count):
+            comparison.add(index, parse(a.readline()), parse(b.readline()))
+    comparison.flush()
+    columns = comparison.feature_columns() if features else None
+    return ([m.state() for m in comparison.metrics], comparison.errors, comparison.diff_count,
+            columns)
+
+
+def measure_parallel(file1, file2, metrics, spec, printnum, judgments_file, jobs,
+                     chunk_size=5000, features=False):
+    """Measure the pairs of results in file1 and file2 in chunks, on a pool
+       of jobs worker processes, and merge the partial states into metrics
+       (built from spec) in file order. Returns the errors, the number of
+       pairs, and the per-query feature columns if features is set.
+    """
+    errors = {}
+    diff_count = 0
+    pending = deque()
+    columns = {}
+    pool = multiprocessing.Pool(jobs, init_worker,
+                                (file1, file2, spec, printnum, judgments_file, features))
+
+    def done(result):
+        (states, chunk_errors, chunk_count, chunk_columns) = result
+        for (m, state) in zip(metrics, states):
+            m.merge(state)
+        errors.update(chunk_errors)
+        for (name, column) in (chunk_columns or {}).items():
+            columns.setdefault(name, []).append(column)
+        return chunk_count
+
+    try:
+        for chunk in chunk_offsets(file1, file2, chunk_size):
+            while len(pending) >= 2 * jobs:
+                # get() re-raises errors from the worker
+                diff_count += done(pending.popleft().get())
+            pending.append(pool.apply_async(measure_chunk, (chunk,)))
+        while pending:
+            diff_count += done(pending.popleft().get())
+    finally:
+        # all results are in unless something failed
+        pool.terminate()
+        pool.join()
+    if features:
+        columns = dict((name, numpy.concatenate(column)) for (name, column) in columns.items())
+    return (errors, diff_count, columns if features else None)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate a report comparing two relevance lab query runs",
@@ -369,6 +1378,27 @@ def main():
                         help="output directory, default is ./comp/")
     parser.add_argument("-p", "--printnum", dest="printnum", default=20,
                         help="number of samples per metric, default is 20")
+    parser.add_argument("-l", "--diff-link", dest="diff_link", default="diffs/diff{}.html",
+                        help="link to the diff of query pair {}, default is " +
+                        "diffs/diff{}.html; use diffs/index.html#{} for jsondiff.py -o container")
+    parser.add_argument("-g", "--judgments", dest="judgments", default=None,
+                        help="tab-separated query, pageId, grade judgments file; " +
+                        "adds NDCG and ERR metrics")
+    parser.add_argument("-m", "--metrics", dest="metrics", default=None,
+                        help="comma separated metrics to compute, each a type followed by " +
+                        "name=value parameters, e.g. 'zeroResults, topN topN=10 sorted=true'; " +
+                        "types are " + ", ".join(sorted(METRICS)) + "; default is queryCount, " +
+                        "zeroResults and topN, with ndcg and err if there are judgments")
+    parser.add_argument("-b", "--bootstrap", dest="bootstrap", default=0, type=int,
+                        help="number of bootstrap resamples for confidence intervals of " +
+                        "the changes, default is 0 for none")
+    parser.add_argument("-s", "--seed", dest="seed", default=0, type=int,
+                        help="random seed of the bootstrap resamples, default is 0")
+    parser.add_argument("-f", "--features", dest="features", action="store_true",
+                        help="also write per-query features and metric values to features.npz")
+    parser.add_argument("-j", "--jobs", dest="jobs", default=1, type=int,
+                        help="number of worker processes measuring chunks of the files, " +
+                        "default is 1")
     args = parser.parse_args()
 
     (file1, file2) = args.file
@@ -378,42 +1408,33 @@ def main():
     if not os.path.exists(target_dir):
         os.makedirs(os.path.dirname(target_dir))
 
-    diff_count = 0
-    errors = {}
-
     # set up metrics
-    # TODO: make this configurable from the .ini file
-    myMetrics = [
-        QueryCount(),
-        ZeroResultsRate(printnum=printnum),
-        TopNDiff(3, sorted=False, printnum=printnum),
-        TopNDiff(3, sorted=True, printnum=printnum),
-        TopNDiff(5, sorted=False, printnum=printnum),
-        TopNDiff(5, sorted=True, printnum=printnum)
-        ]
-
-    with open(file1) as a, open(file2) as b:
-        for tuple in izip_longest(a, b, fillvalue="{}"):
-            (aline, bline) = tuple
-            aline = aline.strip(" \t\n")
-            bline = bline.strip(" \t\n")
-            if aline == "":
-                aline = "{}"
-            if bline == "":
-                bline = "{}"
-            ajson = json.loads(aline)
-            bjson = json.loads(bline)
-
-            diff_count += 1
-
-            if 'error' in ajson or 'error' in bjson:
-                errors[diff_count] = make_query_string(ajson, bjson)
-                continue
-
-            for m in myMetrics:
-                m.measure(ajson, bjson, diff_count)
-
-    print_report(target_dir, diff_count, file1, file2, myMetrics, errors)
+    judgments = Judgments(args.judgments) if args.judgments else None
+    spec = args.metrics or default_spec(judgments is not None)
+    myMetrics = parse_metrics(spec, printnum, judgments)
+
+    if args.jobs > 1:
+        (errors, diff_count, columns) = measure_parallel(file1, file2, myMetrics, spec, printnum,
+                                                         args.judgments, args.jobs,
+                                                         features=args.features)
+    else:
+        comparison = Comparison(myMetrics, features=args.features)
+        # vectorized metrics only need the fields extract_results decodes
+        parse = parse_line if comparison.keep_pairs else fastjson.extract_results
+
+        with open(file1) as a, open(file2) as b:
+            for (index, (aline, bline)) in enumerate(izip_longest(a, b, fillvalue="{}"), 1):
+                comparison.add(index, parse(aline), parse(bline))
+        comparison.flush()
+        (errors, diff_count) = (comparison.errors, comparison.diff_count)
+        columns = comparison.feature_columns() if args.features else None
+
+    print_report(target_dir, diff_count, file1, file2, myMetrics, errors,
+                 diff_link=args.diff_link, resamples=args.bootstrap, seed=args.seed)
+    write_summary(target_dir, diff_count, file1, file2, myMetrics, errors,
+                  resamples=args.bootstrap, seed=args.seed)
+    if columns is not None:
+        write_features(target_dir, columns)
 
 
 if __name__ == "__main__":
@@ -16,12 +16,25 @@
 
 import os
 import sys
+import anydbm
 import argparse
 import ConfigParser
+import glob
+import hashlib
+import json
+import multiprocessing
 import pipes
 import shutil
+import signal
 import subprocess
 import re
+import time
+
+from itertools import combinations, izip
+
+import fastjson
+import jsondiff
+import relcomp
 
 
 def getSafeName(name):
@@ -35,20 +48,456 @@ def refreshDir(dirname):
     os.makedirs(dirname)
 
 
-def runSearch(config, section):
+class Job(object):
+    """A shell command run in the background by runParallel.
+
+    Attributes:
+        name: label used when reporting progress
+        cmd: shell command line to execute
+        output: optional file the command writes one line per query into
+        total: optional number of lines expected in output, for progress
+        proc: the running subprocess.Popen, or None if not started
+        status: exit status once finished, None before that
+    """
+
+    def __init__(self, name, cmd, output=None, total=None):
+        self.name = name
+        self.cmd = cmd
+        self.output = output
+        self.total = total
+        self.proc = None
+        self.status = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        print "RUNNING [%s] %s" % (self.name, self.cmd)
+        self.started = time.time()
+        # run in its own process group so the whole pipeline can be cancelled
+        self.proc = subprocess.Popen(self.cmd, shell=True, preexec_fn=os.setsid)
+
+    def poll(self):
+        if self.status is None and self.proc is not None:
+            self.status = self.proc.poll()
+            if self.status is not None:
+                self.elapsed = time.time() - self.started
+        return self.status
+
+    def cancel(self):
+        if self.proc is not None and self.poll() is None:
+            print "CANCELLING [%s]" % self.name
+            try:
+                os.killpg(self.proc.pid, signal.SIGTERM)
+            except OSError:
+                pass  # already gone
+            self.proc.wait()
+            self.poll()
+
+    def progress(self):
+        if self.output is None or not os.path.exists(self.output):
+            return ""
+        with open(self.output) as f:
+            done = sum(1 for _ in f)
+        if self.total:
+            return "%d/%d" % (done, self.total)
+        return "%d" % done
+
+
+class ProcessJob(Job):
+    """A Job that calls a python function in a child process instead of
+    running a shell command.
+    """
+
+    def __init__(self, name, target, args):
+        super(ProcessJob, self).__init__(name, None)
+        self.target = target
+        self.args = args
+
+    def start(self):
+        print "RUNNING [%s] %s" % (self.name, self.target.__name__)
+        self.started = time.time()
+        self.proc = multiprocessing.Process(target=self.target, args=self.args)
+        self.proc.start()
+
+    def poll(self):
+        if self.status is None and self.proc is not None and not self.proc.is_alive():
+            self.status = self.proc.exitcode
+            self.elapsed = time.time() - self.started
+        return self.status
+
+    def cancel(self):
+        if self.proc is not None and self.poll() is None:
+            print "CANCELLING [%s]" % self.name
+            self.proc.terminate()
+            self.proc.join()
+            self.poll()
+
+
+def runParallel(jobs, maxJobs, interval=30):
+    """Run jobs with at most maxJobs at once, reporting progress every
+    interval seconds. If any job fails the others are cancelled and a
+    RuntimeError is raised.
+    """
+    pending = list(jobs)
+    running = []
+    lastReport = time.time()
+    try:
+        while pending or running:
+            while pending and len(running) < maxJobs:
+                job = pending.pop(0)
+                job.start()
+                running.append(job)
+            time.sleep(0.5)
+            for job in list(running):
+                if job.poll() is None:
+                    continue
+                running.remove(job)
+                print "FINISHED [%s] exit status %d in %.1fs" % (job.name, job.status,
+                                                                 job.elapsed)
+                if job.status != 0:
+                    raise RuntimeError("[%s] failed with exit status %d" %
+                                       (job.name, job.status))
+            if running and time.time() - lastReport >= interval:
+                lastReport = time.time()
+                for job in running:
+                    elapsed = time.time() - job.started
+                    print "PROGRESS [%s] %s (%.0fs)" % (job.name, job.progress(), elapsed)
+    finally:
+        for job in running:
+            job.cancel()
+
+
+def countLines(filename):
+    with open(filename) as f:
+        return sum(1 for _ in f)
+
+
+def splitFile(filename, parts, prefix):
+    """Split filename into at most parts files of consecutive lines named
+    prefix + '.0', prefix + '.1', ...; returns the list of names.
+    """
+    total = countLines(filename)
+    perShard = max(1, -(-total // parts))  # ceiling division
+    names = []
+    out = None
+    with open(filename) as f:
+        for (num, line) in enumerate(f):
+            if num % perShard == 0:
+                if out is not None:
+                    out.close()
+                names.append("%s.%d" % (prefix, len(names)))
+                out = open(names[-1], 'w')
+            out.write(line)
+    if out is not None:
+        out.close()
+    return names
+
+
+def linkOrCopy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+def concatFiles(filenames, target):
+    with open(target, 'w') as out:
+        for name in filenames:
+            with open(name) as f:
+                shutil.copyfileobj(f, out)
+
+
+class ResultsCache(object):
+    """Archive of results from previous runs under workDir/cache, keyed by
+    a hash of everything that determines a run's output. Each entry is a
+    directory whose mtime records its last use; the least recently used
+    entries, whole run results or per-query stores alike, are evicted once
+    the cache grows beyond maxBytes.
+    """
+
+    def __init__(self, root, maxBytes):
+        self.root = root
+        self.maxBytes = maxBytes
+        self.inUse = set()  # entries of open query stores, never evicted
+        self.stores = {}  # path: [open QueryStore, number of runs using it]
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def lookup(self, key):
+        """Return the path of the cached results for key, or None."""
+        results = "%s/%s/results" % (self.root, key)
+        if not os.path.exists(results):
+            return None
+        os.utime(os.path.dirname(results), None)  # mark as recently used
+        return results
+
+    def queryStore(self, configKey):
+        """Return the QueryStore for runs with the given config key. Runs
+        with the same key share it, since a dbm file can't be opened twice.
+        """
+        path = "%s/queries-%s" % (self.root, configKey)
+        if path not in self.stores:
+            self.stores[path] = [QueryStore(path), 0]
+            self.inUse.add(path)
+        self.stores[path][1] += 1
+        return self.stores[path][0]
+
+    def release(self, store):
+        """Close the store once the last run using it releases it."""
+        self.stores[store.path][1] -= 1
+        if self.stores[store.path][1] == 0:
+            del self.stores[store.path]
+            store.close()
+            self.inUse.discard(store.path)
+
+    def store(self, key, results):
+        entry = "%s/%s" % (self.root, key)
+        if os.path.exists(entry):
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+        linkOrCopy(results, entry + "/results")
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for name in os.listdir(self.root):
+            entry = "%s/%s" % (self.root, name)
+            if entry in self.inUse:
+                continue
+            size = sum(os.path.getsize(os.path.join(dirpath, f))
+                       for (dirpath, _, files) in os.walk(entry) for f in files)
+            entries.append((os.path.getmtime(entry), entry, size))
+            total += size
+        for (_, entry, size) in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            print "EVICTING %s from results cache" % entry
+            shutil.rmtree(entry)
+            total -= size
+
+
+class QueryStore(object):
+    """Results of individual queries from previous runs with the same
+    search config, keyed by query string, so that only queries without a
+    stored result need to be sent to the search host. Results that are
+    errors are never stored, so those queries are retried by the next run.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        os.utime(path, None)  # mark as recently used for ResultsCache.evict
+        self.db = anydbm.open(path + "/results", 'c')
+
+    def get(self, query):
+        try:
+            return self.db[query]
+        except KeyError:
+            return None
+
+    def add(self, queries, results):
+        """Store the results of a (possibly interrupted) run of the queries
+        file, pairing them line by line. Returns {query: line} for the
+        results that were errors.
+        """
+        errors = {}
+        if not os.path.exists(results):
+            return errors
+        with open(queries) as q, open(results) as r:
+            for (query, line) in izip(q, r):
+                if not line.endswith('\n'):
+                    break  # last line of an interrupted run
+                query = query.rstrip('\n')
+                try:
+                    failed = 'error' in fastjson.loads(line)
+                except ValueError:
+                    failed = True
+                if failed:
+                    errors[query] = line
+                else:
+                    self.db[query] = line
+        return errors
+
+    def close(self):
+        self.db.close()
+
+
+def getConfigKey(config, section):
+    """Hash everything besides the queries that determines the results of
+    a search run: the search config, command, host and index snapshot.
+    """
+    key = hashlib.sha1()
+    if config.has_option(section, 'config'):
+        key.update(open(config.get(section, 'config')).read())
+    for setting in ['searchCommand', 'labHost', 'snapshot']:
+        value = config.get(section, setting) if config.has_option(section, setting) else ''
+        key.update('\0' + value)
+    return key.hexdigest()
+
+
+def getRunKey(config, section):
+    """Hash the queries and config key of a search run."""
+    key = hashlib.sha1()
+    with open(config.get(section, 'queries')) as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            key.update(chunk)
+    key.update('\0' + getConfigKey(config, section))
+    return key.hexdigest()
+
+
+class SearchRun(object):
+    """The queries for one [test#] section, possibly split into shards that
+    are each searched by their own ssh/runSearch.php worker.
+
+    Attributes:
+        section: name of the config section
+        qdir: directory holding the archived queries, config and results
+        results: path of the merged results file
+        jobs: Jobs that need to complete before finish() is called
+        shards: (queries, results) file pairs, in original query order
+        cache: ResultsCache to store the results in, or None
+        key: the cache key of this run
+        store: QueryStore holding per-query results, or None
+        errors: {query: line} of error results collected from the shards
+    """
+
+    def __init__(self, section, qdir, cache=None, key=None):
+        self.section = section
+        self.qdir = qdir
+        self.results = qdir + "/results"
+        self.jobs = []
+        self.shards = []
+        self.cache = cache
+        self.key = key
+        self.store = None
+        self.errors = {}
+
+    def collect(self):
+        """Save whatever the shards produced in the query store. This is
+        also done when the run failed, so the next run can resume.
+        """
+        if self.store is not None:
+            for (queries, results) in self.shards:
+                self.errors.update(self.store.add(queries, results))
+            self.shards = []
+            if os.path.exists(self.qdir + '/storeKey'):
+                os.remove(self.qdir + '/storeKey')
+
+    def finish(self):
+        """Merge shard results back into a single file in query order,
+        then archive them in the results cache.
+        """
+        if self.store is not None:
+            self.collect()
+            with open(self.qdir + '/queries') as q, open(self.results, 'w') as out:
+                for query in q:
+                    query = query.rstrip('\n')
+                    line = self.store.get(query) or self.errors.get(query)
+                    if line is None:
+                        line = json.dumps({'query': query, 'error': 'no result'}) + '\n'
+                    out.write(line)
+            self.cache.release(self.store)
+            self.store = None
+            if os.path.exists(self.qdir + "/shards"):
+                shutil.rmtree(self.qdir + "/shards")
+            if not self.errors:
+                self.cache.store(self.key, self.results)
+            return
+        if not self.jobs:
+            return  # reused cached results
+        if len(self.shards) > 1:
+            concatFiles([res for (_, res) in self.shards], self.results)
+            shutil.rmtree(self.qdir + "/shards")
+        if self.cache is not None:
+            self.cache.store(self.key, self.results)
+
+
+def recoverResults(qdir, cache):
+    """Store the results left in qdir by a run that was killed before it
+    could store them itself, so they aren't searched again. Such runs
+    leave the config key of their query store in qdir/storeKey.
+    """
+    if not os.path.exists(qdir + '/storeKey'):
+        return
+    with open(qdir + '/storeKey') as f:
+        store = cache.queryStore(f.read().strip())
+    try:
+        shards = [(qdir + '/pending', qdir + '/fresh')]
+        shards += [(name, name.replace('/queries.', '/results.'))
+                   for name in glob.glob(qdir + '/shards/queries.*')]
+        for (queries, results) in shards:
+            if os.path.exists(queries):
+                store.add(queries, results)
+        print "RECOVERED results of an interrupted run from %s" % qdir
+    finally:
+        cache.release(store)
+
+
+def runSearch(config, section, cache=None):
+    """Prepare the query directory for section and return a SearchRun
+    whose jobs will write its results. If cache holds the results of an
+    identical run they are reused and no jobs are created; otherwise only
+    the queries missing from its per-query store are searched.
+    """
     qname = getSafeName(config.get(section, 'name'))
     qdir = config.get('settings', 'workDir') + "/queries/" + qname
+    if cache is not None:
+        recoverResults(qdir, cache)
     refreshDir(qdir)
+    run = SearchRun(section, qdir, cache, getRunKey(config, section))
     cmdline = config.get(section, 'searchCommand')
     if config.has_option(section, 'config'):
         cmdline += " --options " + pipes.quote(open(config.get(section, 'config')).read())
         shutil.copyfile(config.get(section, 'config'),
                         qdir + '/config.json')  # archive search config
-    runCommand("cat %s | ssh %s %s > %s" % (config.get(section, 'queries'),
-                                            config.get(section, 'labHost'),
-                                            pipes.quote(cmdline), qdir + "/results"))
     shutil.copyfile(config.get(section, 'queries'), qdir + '/queries')  # archive queries
-    return qdir + "/results"
+    queries = qdir + '/queries'
+    results = run.results
+
+    if cache is not None:
+        cached = cache.lookup(run.key)
+        if cached is not None:
+            print "REUSING cached results %s for [%s]" % (cached, section)
+            linkOrCopy(cached, run.results)
+            return run
+        run.store = cache.queryStore(getConfigKey(config, section))
+        total = 0
+        pending = set()
+        with open(qdir + '/queries') as q, open(qdir + '/pending', 'w') as out:
+            for query in q:
+                total += 1
+                key = query.rstrip('\n')
+                if key not in pending and run.store.get(key) is None:
+                    pending.add(key)
+                    out.write(query)
+        print "SEARCHING %d of %d queries for [%s]" % (len(pending), total, section)
+        if not pending:
+            return run
+        with open(qdir + '/storeKey', 'w') as f:
+            f.write(getConfigKey(config, section))  # until collect() stores the results
+        queries = qdir + '/pending'
+        results = qdir + '/fresh'
+
+    workers = 1
+    if config.has_option(section, 'workers'):
+        workers = config.getint(section, 'workers')
+    if workers > 1:
+        os.makedirs(qdir + "/shards")
+        shards = splitFile(queries, workers, qdir + "/shards/queries")
+        run.shards = [(name, name.replace("/queries.", "/results.")) for name in shards]
+    else:
+        run.shards = [(queries, results)]
+
+    for (num, (queries, results)) in enumerate(run.shards):
+        name = section if len(run.shards) == 1 else "%s.%d" % (section, num)
+        run.jobs.append(Job(name,
+                            "cat %s | ssh %s %s > %s" % (queries,
+                                                         config.get(section, 'labHost'),
+                                                         pipes.quote(cmdline), results),
+                            output=results, total=countLines(queries)))
+    return run
 
 
 def distributeGlobalSettings(config, globals, sections, settings):
@@ -66,9 +515,128 @@ def checkSettings(config, section, settings):
     pass
 
 
-def runCommand(cmd):
-    print "RUNNING "+cmd
-    subprocess.check_call(cmd, shell=True)
+def getTestSections(config):
+    """Return the [test#] sections of config in numeric order."""
+    sections = [sec for sec in config.sections() if re.match(r'^test\d+$', sec)]
+    return sorted(sections, key=lambda sec: int(sec[4:]))
+
+
+def getComparisons(config, sections):
+    """Return the (baseline, delta) section pairs to compare. By default
+    the baseline section (the first test unless configured) is compared to
+    every other test; comparisons = all compares every pair of tests.
+    """
+    mode = 'baseline'
+    if config.has_option('settings', 'comparisons'):
+        mode = config.get('settings', 'comparisons')
+    if mode == 'all':
+        return list(combinations(sections, 2))
+    elif mode == 'baseline':
+        baseline = sections[0]
+        if config.has_option('settings', 'baseline'):
+            baseline = config.get('settings', 'baseline')
+        if baseline not in sections:
+            raise ValueError("Baseline [%s] is not a test section" % baseline)
+        return [(baseline, sec) for sec in sections if sec != baseline]
+    raise ValueError("Unknown comparisons mode %s" % mode)
+
+
+def compareInProcess(res1, res2, comparisonDir, diffs, metrics, options):
+    """Parse both results files once, feeding each pair of records to the
+    relcomp metrics and/or the jsondiff diff generator.
+    """
+    diffDir = comparisonDir + "/diffs/"
+    if diffs:
+        jsondiff.prepare_dir(diffDir)
+        writer = jsondiff.DiffWriter(diffDir, res1, res2, jobs=options['diffJobs'],
+                                     mode=options['diffMode'], output=options['diffOutput'])
+    judgments = None
+    if options['judgments']:
+        judgments = relcomp.Judgments(options['judgments'])
+    if options['metrics']:
+        myMetrics = relcomp.parse_metrics(options['metrics'], options['printnum'], judgments)
+    else:
+        myMetrics = relcomp.default_metrics(options['printnum'], judgments)
+    comparison = relcomp.Comparison(myMetrics, features=options['features'])
+    parse = jsondiff.parse_line
+    if not diffs and not comparison.keep_pairs:
+        parse = fastjson.extract_results  # all the metrics need
+    diffCount = 0
+    for (diffCount, aresults, bresults) in jsondiff.read_pairs(res1, res2, parse):
+        if metrics:
+            comparison.add(diffCount, aresults, bresults)
+            if diffs and comparison.keep_pairs:
+                # metrics that aren't vectorized measure the kept records
+                # when the batch is flushed, and make_diff modifies them
+                comparison.flush()
+        if diffs:
+            writer.add(diffCount, aresults, bresults)
+    if diffs:
+        writer.close()
+        print "Skipped %d identical pairs out of %d" % (writer.identical, diffCount)
+    if metrics:
+        diffLink = "diffs/diff{}.html"
+        if options['diffOutput'] == 'container':
+            diffLink = "diffs/index.html#{}"
+        comparison.flush()
+        relcomp.print_report(comparisonDir + "/", diffCount, res1, res2, myMetrics,
+                             comparison.errors, diff_link=diffLink,
+                             resamples=options['bootstrap'], seed=options['bootstrapSeed'])
+        relcomp.write_summary(comparisonDir + "/", diffCount, res1, res2, myMetrics,
+                              comparison.errors, resamples=options['bootstrap'],
+                              seed=options['bootstrapSeed'])
+        if options['features']:
+            relcomp.write_features(comparisonDir + "/", comparison.feature_columns())
+
+
+def getOption(config, section, option, default):
+    """Return option from section, as an int if default is one, or default
+    if it is not set.
+    """
+    if not config.has_option(section, option):
+        return default
+    if isinstance(default, int):
+        return config.getint(section, option)
+    return config.get(section, option)
+
+
+def compareResults(config, configFile, section1, section2, res1, res2):
+    """Prepare the comparison directory for a pair of sections and return
+    the Jobs that generate the diffs and the metrics report. Those are
+    computed in a single pass over the results, unless jsonDiffTool or
+    metricTool configure an external command to use instead.
+    """
+    comparisonDir = "%s/comparisons/%s_%s" % (config.get('settings', 'workDir'),
+                                              getSafeName(config.get(section1, 'name')),
+                                              getSafeName(config.get(section2, 'name')))
+    refreshDir(comparisonDir)
+    shutil.copyfile(configFile, comparisonDir + "/config.ini")  # archive comparison config
+    name = "%s_%s" % (section1, section2)
+    jobs = []
+    diffs = not config.has_option('settings', 'jsonDiffTool')
+    if not diffs:
+        jobs.append(Job("diff " + name, "%s %s %s %s" % (config.get('settings', 'jsonDiffTool'),
+                                                         comparisonDir + "/diffs", res1, res2)))
+    metrics = not config.has_option('settings', 'metricTool')
+    if not metrics:
+        jobs.append(Job("metrics " + name, "%s %s %s %s" % (config.get('settings', 'metricTool'),
+                                                            comparisonDir, res1, res2)))
+    if diffs or metrics:
+        options = {
+            'printnum': getOption(config, 'settings', 'printnum', 20),
+            'diffJobs': getOption(config, 'settings', 'diffJobs', 1),
+            'diffMode': getOption(config, 'settings', 'diffMode', 'text'),
+            'diffOutput': getOption(config, 'settings', 'diffOutput', 'files'),
+            'judgments': getOption(config, 'settings', 'judgments', None),
+            'metrics': getOption(config, 'settings', 'metrics', None),
+            'bootstrap': getOption(config, 'settings', 'bootstrap', 0),
+            'bootstrapSeed': getOption(config, 'settings', 'bootstrapSeed', 0),
+            'features': (config.has_option('settings', 'features') and
+                         config.getboolean('settings', 'features')),
+        }
+        jobs.append(ProcessJob("compare " + name, compareInProcess,
+                               (res1, res2, comparisonDir, diffs, metrics, options)))
+    return jobs
 
 
 parser = argparse.ArgumentParser(description='Run relevance lab queries', prog=sys.argv[0])
@@ -77,20 +645,49 @@ args = parser.parse_args()
 
 config = ConfigParser.ConfigParser()
 config.readfp(open(args.config))
-distributeGlobalSettings(config, 'settings', ['test1', 'test2'],
-                         ['queries', 'labHost', 'searchCommand', 'config'])
-checkSettings(config, 'settings', ['workDir', 'jsonDiffTool', 'metricTool'])
-checkSettings(config, 'test1', ['name', 'queries', 'labHost', 'searchCommand'])
-checkSettings(config, 'test2', ['name', 'queries', 'labHost', 'searchCommand'])
-
-res1 = runSearch(config, 'test1')
-res2 = runSearch(config, 'test2')
-comparisonDir = "%s/comparisons/%s_%s" % (config.get('settings', 'workDir'),
-                                          getSafeName(config.get('test1', 'name')),
-                                          getSafeName(config.get('test2', 'name')))
-refreshDir(comparisonDir)
-shutil.copyfile(args.config, comparisonDir + "/config.ini")  # archive comparison config
-
-runCommand("%s %s %s %s" % (config.get('settings', 'jsonDiffTool'),
-                            comparisonDir + "/diffs", res1, res2))
-runCommand("%s %s %s %s" % (config.get('settings', 'metricTool'), comparisonDir, res1, res2))
+sections = getTestSections(config)
+if len(sections) < 2:
+    raise ValueError("At least two [test#] sections are needed for a comparison")
+distributeGlobalSettings(config, 'settings', sections,
+                         ['queries', 'labHost', 'searchCommand', 'config', 'workers', 'snapshot'])
+checkSettings(config, 'settings', ['workDir'])
+for sec in sections:
+    checkSettings(config, sec, ['name', 'queries', 'labHost', 'searchCommand'])
+names = [getSafeName(config.get(sec, 'name')) for sec in sections]
+if len(set(names)) != len(names):
+    raise ValueError("Test names must be unique: %s" % ', '.join(names))
+comparisons = getComparisons(config, sections)
+if config.has_option('settings', 'metrics'):
+    # check the metrics configuration before running any queries
+    judgments = None
+    if config.has_option('settings', 'judgments'):
+        judgments = relcomp.Judgments(config.get('settings', 'judgments'))
+    relcomp.parse_metrics(config.get('settings', 'metrics'), judgments=judgments)
+
+cache = None
+if config.has_option('settings', 'cacheSize') and config.getint('settings', 'cacheSize') > 0:
+    cache = ResultsCache(config.get('settings', 'workDir') + "/cache",
+                         config.getint('settings', 'cacheSize') << 20)
+
+# run each query set once, no matter how many comparisons it is part of
+runs = dict((sec, runSearch(config, sec, cache)) for sec in sections)
+jobs = [job for sec in sections for job in runs[sec].jobs]
+maxParallel = len(jobs)
+if config.has_option('settings', 'maxParallel'):
+    maxParallel = config.getint('settings', 'maxParallel')
+try:
+    runParallel(jobs, maxParallel)
+finally:
+    for sec in sections:
+        runs[sec].collect()
+for sec in sections:
+    runs[sec].finish()
+
+jobs = []
+for (sec1, sec2) in comparisons:
+    jobs += compareResults(config, args.config, sec1, sec2,
+                           runs[sec1].results, runs[sec2].results)
+maxParallel = len(jobs)
+if config.has_option('settings', 'maxParallel'):
+    maxParallel = config.getint('settings', 'maxParallel')
+runParallel(jobs, maxParallel)
@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import fastjson  # noqa: E402
+
+
+def explanation(depth):
+    """A nested explanation, with brackets, quotes and keys in descriptions"""
+    exp = {'value': 1.5, 'description': 'weight(text:"pageId": 7 [x]) {"rows": [1]}',
+           'details': []}
+    if depth:
+        exp['details'] = [explanation(depth - 1), explanation(depth - 1)]
+    return exp
+
+
+def row(page_id, **fields):
+    fields['pageId'] = page_id
+    fields.setdefault('title', u'Page "%s" ]}' % page_id)
+    return fields
+
+
+def expected(results):
+    """The fields extract_results decodes from a line of parsed results"""
+    if 'error' in results or not isinstance(results.get('rows'), list):
+        return results
+    projected = {'rows': [{'pageId': r['pageId']} if 'pageId' in r else {}
+                          for r in results['rows']]}
+    for key in ('query', 'totalHits'):
+        if key in results:
+            projected[key] = results[key]
+    return projected
+
+
+LINES = [
+    {'query': u'foo', 'totalHits': 3, 'rows': [row(1), row(2), row(3)]},
+    {'query': u'\u00e9t\u00e9 "quoted" \\ [x]', 'totalHits': 0, 'rows': []},
+    {'query': u'no rows', 'totalHits': 0},
+    {'error': u'Bad "rows" request'},
+    {},
+    {'query': u'explained', 'totalHits': 25,
+     'rows': [row(10, explanation=explanation(6), snippets={'text': u'a "pageId": 3'}),
+              row(11, explanation=explanation(3))]},
+    {'alternative': {'query': u'sorted first', 'rows': [{'pageId': 99}]},
+     'query': u'original', 'totalHits': 2, 'rows': [row(4), row(5)],
+     'interwiki': {'enwiktionary': {'totalHits': 7, 'rows': [row(100), row(101)]}},
+     'suggestion': {'query': u'suggested', 'totalHits': 12, 'pageId': 55}},
+    {'rows': [row(6), {'title': u'no pageId', 'pageIds': [1, 2]}, row(7, related=[row(8)])],
+     'totalHits': 2, 'query': u'last'},
+    {'query': u'outer', 'totalHits': 1, 'rows': [row(15)], 'queries': [{'query': u'inner'}]},
+    {'query': u'other rows', 'interwiki': {'rows': [row(12)]}},
+    {'query': u'float hits', 'totalHits': 1.5, 'rows': [row(13)]},
+    {'query': u'string id', 'totalHits': 1, 'rows': [{'pageId': u'14'}]},
+    {'query': u'float id', 'totalHits': 1, 'rows': [{'pageId': 14.5}]},
+    {'query': u'pageId', 'totalHits': 1, 'rows': [row(15, title=u'pageId')]},
+    {'query': u'no list', 'totalHits': 0, 'rows': None},
+    {'query': 5, 'totalHits': 1, 'rows': [row(16)]},
+    ]
+
+
+class ExtractResultsTest(unittest.TestCase):
+    def test_blank(self):
+        self.assertEqual({}, fastjson.extract_results(''))
+        self.assertEqual({}, fastjson.extract_results(' \t\n'))
+
+    def test_matches_loads(self):
+        for results in LINES:
+            for separators in ((', ', ': '), (',', ':')):
+                # sorted, so that some sections come before the top-level fields
+                line = json.dumps(results, separators=separators, sort_keys=True) + '\n'
+                self.assertEqual(expected(fastjson.loads(line)), fastjson.extract_results(line),
+                                 line[0:200])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,406 @@
+import BaseHTTPServer
+import gzip
+import itertools
+import json
+import os
+import random
+import shutil
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import importindices  # noqa: E402
+
+
+def gzip_member(data):
+    out = StringIO()
+    f = gzip.GzipFile(fileobj=out, mode='wb')
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+def make_import(size):
+    imp = importindices.WikiImport('testwiki', 'http://localhost/dump.json.gz',
+                                   'http://localhost:9200/testwiki_content', size)
+    imp.indexer = Indexed()
+    return imp
+
+
+class Indexed(object):
+    acked = 0
+
+
+class ReadDumpTest(unittest.TestCase):
+    def setUp(self):
+        self.chunk = importindices.STREAM_CHUNK
+        importindices.STREAM_CHUNK = 4096
+        self.scheduler = importindices.ImportScheduler('/tmp')
+        self.scheduler.log = lambda imp, message: None
+
+    def tearDown(self):
+        importindices.STREAM_CHUNK = self.chunk
+
+    def read(self, dump):
+        imp = make_import(len(dump))
+        # bounded, so a reader that never finishes fails instead of hanging
+        chunks = itertools.islice(self.scheduler.read_dump(imp, StringIO(dump)), 1000)
+        return ''.join(chunks)
+
+    def test_single_member(self):
+        data = ''.join('{"index":{"_id":%d}}\n{"title":"%x"}\n' % (i, random.getrandbits(256))
+                       for i in range(2000))
+        self.assertEqual(data, self.read(gzip_member(data)))
+
+    def test_multiple_members(self):
+        members = [''.join('{"index":{"_id":%d}}\n{"title":"%x"}\n' %
+                           (i, random.getrandbits(256)) for i in range(n))
+                   for n in (1500, 700, 2300)]
+        dump = ''.join(gzip_member(member) for member in members)
+        # member boundaries fall in the middle of chunks
+        self.assertNotEqual(0, len(gzip_member(members[0])) % importindices.STREAM_CHUNK)
+        self.assertEqual(''.join(members), self.read(dump))
+
+    def test_truncated(self):
+        dump = gzip_member('{"index":{"_id":1}}\n{"title":"a"}\n' * 1000)
+        imp = make_import(len(dump) + 1)
+        with self.assertRaises(RuntimeError):
+            list(self.scheduler.read_dump(imp, StringIO(dump)))
+
+
+class BulkServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A stand-in for the elasticsearch bulk api. respond(lines) returns the
+    status and body of the response to the lines of a bulk request, and by
+    default indexes everything.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), BulkHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.seen = {}
+        self.indexed = set()
+        self.respond = self.index
+
+    def index(self, lines, item_status=lambda _id, seen: 201):
+        items = []
+        for action in lines[::2]:
+            _id = json.loads(action)['index']['_id']
+            with self.lock:
+                self.seen[_id] = self.seen.get(_id, 0) + 1
+                status = item_status(_id, self.seen[_id])
+                if status < 300:
+                    self.indexed.add(_id)
+            item = {'_id': _id, 'status': status}
+            if status >= 300:
+                item['error'] = {'type': 'test_exception', 'reason': 'status %d' % status}
+            items.append({'index': item})
+        errors = any(item['index']['status'] >= 300 for item in items)
+        return 200, json.dumps({'took': 1, 'errors': errors, 'items': items})
+
+
+class BulkHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        lines = body.split('\n')
+        assert lines.pop() == ''
+        assert len(lines) % 2 == 0
+        with self.server.lock:
+            self.server.requests += 1
+        status, response = self.server.respond(lines)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, *args):
+        pass
+
+
+class BulkIndexerTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff = importindices.BACKOFF
+        importindices.BACKOFF = 0.01
+        self.server = BulkServer()
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/testwiki_content/_bulk' % self.server.server_address[1]
+        self.messages = []
+
+    def tearDown(self):
+        importindices.BACKOFF = self.backoff
+        self.server.shutdown()
+        self.server.server_close()
+
+    def index(self, docs=1000, concurrency=3):
+        """Index docs documents in small batches, returning the indexer and
+        what close() raised, if anything.
+        """
+        indexer = importindices.BulkIndexer(self.url, 2000, concurrency, self.messages.append)
+        data = ''.join('{"index":{"_id":"%d"}}\n{"title":"Page %d"}\n' % (i, i)
+                       for i in range(docs))
+        result = {}
+
+        def run():
+            try:
+                for i in range(0, len(data), 1000):
+                    indexer.add(data[i:i + 1000])
+                indexer.close()
+            except Exception as e:
+                result['error'] = e
+            finally:
+                indexer.abort()
+                indexer.join()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), 'indexing hung')
+        return indexer, result.get('error')
+
+    def test_index(self):
+        indexer, error = self.index()
+        self.assertIsNone(error)
+        self.assertEqual(1000, indexer.sent)
+        self.assertEqual(1000, indexer.acked)
+        self.assertEqual(1000, len(self.server.indexed))
+        self.assertEqual(2000, indexer.acked_lines)
+        self.assertGreater(self.server.requests, 3)
+        # batches are sent over keep-alive connections
+        self.assertLessEqual(self.server.connections, 3)
+
+    def test_rejected_requests(self):
+        rejected = [5]
+
+        def respond(lines):
+            with self.server.lock:
+                rejected[0] -= 1
+                if rejected[0] >= 0:
+                    return 429, '{"error":"es_rejected_execution_exception","status":429}'
+            return self.server.index(lines)
+        self.server.respond = respond
+        indexer, error = self.index()
+        self.assertIsNone(error)
+        self.assertEqual(1000, indexer.acked)
+        self.assertEqual(0, indexer.failed)
+        self.assertGreater(indexer.rejected, 0)
+        self.assertIn('Rejected, lowering concurrency to 1', self.messages)
+
+    def test_rejected_items(self):
+        # every document is rejected the first time it is sent
+        self.server.respond = lambda lines: self.server.index(
+            lines, lambda _id, seen: 429 if seen == 1 else 201)
+        indexer, error = self.index()
+        self.assertIsNone(error)
+        self.assertEqual(1000, indexer.acked)
+        self.assertEqual(1000, indexer.rejected)
+        self.assertEqual(0, indexer.failed)
+        self.assertEqual(set(str(i) for i in range(1000)), self.server.indexed)
+        self.assertEqual(2000, indexer.acked_lines)
+
+    def test_failed_items(self):
+        self.server.respond = lambda lines: self.server.index(
+            lines, lambda _id, seen: 400 if int(_id) % 100 == 50 else 201)
+        indexer, error = self.index()
+        self.assertIsNone(error)
+        self.assertEqual(990, indexer.acked)
+        self.assertEqual(10, indexer.failed)
+        self.assertEqual('50 test_exception: status 400', indexer.errors[0])
+        # the checkpoint stops before the first batch with a failure
+        self.assertLess(indexer.acked_lines, 101)
+
+    def test_error_status(self):
+        self.server.respond = lambda lines: (400, '{"error":"bad request","status":400}')
+        indexer, error = self.index()
+        self.assertIsInstance(error, RuntimeError)
+        self.assertIn('status 400', str(error))
+
+    def test_invalid_responses(self):
+        for response in ('<html><body>Welcome</body></html>', '{"took":1}',
+                         '{"took":1,"errors":false,"items":[1,2]}'):
+            self.server.respond = lambda lines: (200, response)
+            indexer, error = self.index(concurrency=1)
+            self.assertIsInstance(error, RuntimeError)
+            self.assertIn('Invalid bulk response', str(error))
+
+
+class ImportSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.scheduler = importindices.ImportScheduler(self.temp_dir)
+        self.scheduler.log = lambda imp, message: None
+        self.scheduler.reserve = lambda imp: None
+        self.imports = [make_import(100) for _ in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def run_scheduler(self):
+        """Run the scheduler, returning what it raised, if anything"""
+        result = {}
+
+        def run():
+            try:
+                self.scheduler.run(self.imports)
+            except BaseException as e:
+                result['error'] = e
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(30)
+        self.assertFalse(thread.is_alive(), 'scheduler hung')
+        return result.get('error')
+
+    def test_interrupted_download(self):
+        started = threading.Event()
+
+        def download(imp):
+            # like run_command, until abort() stops the command
+            started.set()
+            while not self.scheduler.aborted:
+                time.sleep(0.01)
+            raise importindices.Aborted()
+        self.scheduler.download = download
+        wait = self.scheduler.wait
+
+        def interrupted_wait(threads):
+            # Ctrl-C while waiting for the downloads
+            self.scheduler.wait = wait
+            started.wait(10)
+            raise KeyboardInterrupt()
+        self.scheduler.wait = interrupted_wait
+        self.assertIsInstance(self.run_scheduler(), KeyboardInterrupt)
+        self.assertEqual(['failed'] * 3, [imp.status for imp in self.imports])
+
+    def test_unexpected_errors(self):
+        self.scheduler.download = lambda imp: None
+
+        def import_index(imp):
+            if imp is self.imports[0]:
+                raise ValueError('unexpected')
+            imp.timings['import'] = 0
+        self.scheduler.import_index = import_index
+        self.assertIsNone(self.run_scheduler())
+        self.assertEqual(['failed', 'done', 'done'], [imp.status for imp in self.imports])
+        self.assertEqual('ValueError: unexpected', self.imports[0].error)
+
+    def test_unexpected_download_errors(self):
+        def download(imp):
+            raise OSError('unexpected')
+        self.scheduler.download = download
+        self.assertIsNone(self.run_scheduler())
+        self.assertEqual(['failed'] * 3, [imp.status for imp in self.imports])
+
+    def test_failed_restore(self):
+        self.scheduler.download = lambda imp: None
+        self.scheduler.tune = True
+        self.scheduler.tune_index = lambda imp: {'refresh_interval': '1s'}
+        self.scheduler.refresh_index = lambda imp: None
+        restored = []
+
+        def bulk_import(imp):
+            if imp is self.imports[0]:
+                raise RuntimeError('3 documents failed to index')
+        self.scheduler.bulk_import = bulk_import
+
+        def restore_index(imp, settings):
+            restored.append(imp)
+            if imp is not self.imports[2]:
+                raise RuntimeError('Restoring the index settings failed')
+        self.scheduler.restore_index = restore_index
+        self.assertIsNone(self.run_scheduler())
+        self.assertEqual(['failed', 'failed', 'done'], [imp.status for imp in self.imports])
+        # the import failure, not the restore one
+        self.assertEqual('3 documents failed to index', self.imports[0].error)
+        self.assertEqual('Restoring the index settings failed', self.imports[1].error)
+        self.assertEqual(self.imports, sorted(restored, key=self.imports.index))
+
+
+class AdminHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers every request with the server's response, a status and body,
+    or closes the connection when it is None.
+    """
+
+    def respond(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if self.server.response is None:
+            self.close_connection = 1
+            return
+        status, body = self.server.response
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_PUT = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class TuneIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), AdminHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.temp_dir = tempfile.mkdtemp()
+        self.scheduler = importindices.ImportScheduler(self.temp_dir, tune=True, force_merge=1)
+        self.scheduler.log = lambda imp, message: None
+        self.imp = importindices.WikiImport(
+            'testwiki', 'http://localhost/dump.json.gz',
+            'http://127.0.0.1:%d/testwiki_content' % self.server.server_address[1], 100)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_tune(self):
+        self.server.response = (200, json.dumps({'testwiki_content_first': {'settings': {
+            'index': {'refresh_interval': '5s', 'number_of_replicas': '2'}}}}))
+        settings = self.scheduler.tune_index(self.imp)
+        self.assertEqual({'refresh_interval': '5s', 'number_of_replicas': '2',
+                          'auto_expand_replicas': 'false'}, settings)
+        self.server.response = (200, '{"acknowledged":true}')
+        self.scheduler.restore_index(self.imp, settings)
+        self.assertEqual([], os.listdir(self.temp_dir))
+
+    def test_bad_responses(self):
+        calls = [lambda: self.scheduler.tune_index(self.imp),
+                 lambda: self.scheduler.restore_index(self.imp, {}),
+                 lambda: self.scheduler.refresh_index(self.imp),
+                 lambda: self.scheduler.merge_index(self.imp)]
+        for response in [(200, '<html>Welcome</html>'), (500, '{"error":"broken"}'), None]:
+            self.server.response = response
+            for call in calls:
+                self.assertRaises(RuntimeError, call)
+        # settings that aren't where they should be
+        for response in [(200, '{}'), (200, '[]'), (200, '{"testwiki_content": 1}')]:
+            self.server.response = response
+            self.assertRaises(RuntimeError, calls[0])
+
+    def test_restore_without_saved_settings(self):
+        self.server.response = (200, '{"acknowledged":true}')
+        with self.assertRaises(RuntimeError):
+            self.scheduler.restore_index(self.imp, {'refresh_interval': '1s'})
+
+
+if __name__ == '__main__':
+    unittest.main()
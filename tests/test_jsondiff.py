@@ -0,0 +1,56 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import jsondiff  # noqa: E402
+
+
+def results(query, page_ids):
+    return {'query': query, 'totalHits': len(page_ids),
+            'rows': [{'pageId': page_id, 'title': 'Page %d' % page_id} for page_id in page_ids]}
+
+
+class DiffWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_diffs(self, jobs, output):
+        target_dir = os.path.join(self.temp_dir, '%s%d' % (output, jobs)) + '/'
+        os.makedirs(target_dir)
+        writer = jsondiff.DiffWriter(target_dir, 'a', 'b', jobs=jobs, chunk_size=3,
+                                     mode='structural', output=output)
+        for n in range(1, 61):
+            a = results('query %d' % n, [1, 2, 3])
+            # every third pair differs, the rest are identical
+            b = results('query %d' % n, [3, 2, 1] if n % 3 == 0 else [1, 2, 3])
+            writer.add(n, a, b)
+        writer.close()
+        self.assertEqual(40, writer.identical)
+        return target_dir
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_order_does_not_depend_on_jobs(self):
+        for output in ('files', 'container'):
+            serial = self.write_diffs(1, output)
+            parallel = self.write_diffs(3, output)
+            records = [json.loads(line)['diff']
+                       for line in self.read(parallel + 'diffs.jsonl').splitlines()]
+            self.assertEqual(range(1, 61), records)
+            self.assertEqual(self.read(serial + 'diffs.jsonl'),
+                             self.read(parallel + 'diffs.jsonl'))
+        self.assertEqual(self.read(serial + 'diffs.idx'), self.read(parallel + 'diffs.idx'))
+        self.assertEqual(self.read(serial + 'diffs.dat'), self.read(parallel + 'diffs.dat'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,307 @@
+import json
+import numpy
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+from itertools import izip_longest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import fastjson  # noqa: E402
+import relcomp  # noqa: E402
+
+
+def make_results(rng, query):
+    """Random parsed results: empty JSON, no hits, or up to 8 rows drawn from
+       a few pageIds, so that the top results often overlap or repeat
+    """
+    if rng.random() < 0.05:
+        return {}
+    rows = [{'pageId': rng.randint(1, 10)} for _ in range(rng.choice([0, 1, 2, 3, 5, 8]))]
+    hits = len(rows) + rng.choice([0, 0, 20]) if rows else 0
+    return {'query': query, 'totalHits': hits, 'rows': rows}
+
+
+def make_pairs(count, seed=0):
+    """Random (baseline, delta) pairs; empty JSON only faces no hits, like
+       the per-pair TopNDiff expects
+    """
+    rng = random.Random(seed)
+    pairs = []
+    for n in range(count):
+        query = u'query %d' % n
+        (a, b) = (make_results(rng, query), make_results(rng, query))
+        if rng.random() < 0.3:
+            b = {'query': query, 'totalHits': a.get('totalHits', 0),
+                 'rows': list(a.get('rows', []))}
+        if a == {} and b.get('totalHits'):
+            a = {'query': query, 'totalHits': 0, 'rows': []}
+        if b == {} and a.get('totalHits'):
+            b = {'query': query, 'totalHits': 0, 'rows': []}
+        pairs.append((a, b))
+    return pairs
+
+
+def make_batch(pairs, depth, keep_pairs=False):
+    batch = relcomp.FeatureBatch(depth, keep_pairs)
+    for (index, (a, b)) in enumerate(pairs, 1):
+        batch.add(index, a, b)
+    batch.finish()
+    return batch
+
+
+class PairMetric(relcomp.Metric):
+    """TopNDiff without its vectorized batch_condition"""
+
+    def __init__(self, topN, sorted):
+        super(PairMetric, self).__init__("pairs", symmetric=True)
+        self.topN = relcomp.TopNDiff(topN, sorted)
+        self.depth = topN
+
+    def has_condition(self, x, y):
+        return self.topN.has_condition(x, y)
+
+
+COUNTS = ('total_queries', 'baseline_count', 'delta_count', 'b2d_count', 'd2b_count')
+
+
+class BatchConditionTest(unittest.TestCase):
+    def setUp(self):
+        self.pairs = make_pairs(2000)
+
+    def check(self, metric):
+        batch = make_batch(self.pairs, max(metric.depth, 1))
+        for reverse in (False, True):
+            batched = metric.batch_condition(batch, reverse)
+            wrong = [pair for (pair, value) in zip(self.pairs, batched)
+                     if value != bool(metric.has_condition(*(pair[::-1] if reverse else pair)))]
+            self.assertEqual([], wrong[0:3], "%s reverse=%s" % (metric.name, reverse))
+
+    def test_top_n(self):
+        for topN in (1, 3, 5, 10):
+            self.check(relcomp.TopNDiff(topN, sorted=False))
+            self.check(relcomp.TopNDiff(topN, sorted=True))
+
+    def test_zero_results(self):
+        self.check(relcomp.ZeroResultsRate())
+
+    def test_query_count(self):
+        self.check(relcomp.QueryCount())
+
+    def test_measure_batch(self):
+        for make in (relcomp.QueryCount, relcomp.ZeroResultsRate,
+                     lambda: relcomp.TopNDiff(3, sorted=True),
+                     lambda: PairMetric(3, sorted=False)):
+            (per_pair, batched) = (make(), make())
+            for (index, (a, b)) in enumerate(self.pairs, 1):
+                per_pair.measure(a, b, index)
+            # the kept pairs are measured with has_condition
+            comparison = relcomp.Comparison([batched], batch_size=300)
+            for (index, (a, b)) in enumerate(self.pairs, 1):
+                comparison.add(index, a, b)
+            comparison.flush()
+            self.assertEqual(not batched.vectorized, comparison.keep_pairs)
+            for count in COUNTS:
+                self.assertEqual(getattr(per_pair, count), getattr(batched, count),
+                                 "%s %s" % (per_pair.name, count))
+
+
+def ranking(*page_ids):
+    return {'query': u'q', 'totalHits': len(page_ids),
+            'rows': [{'pageId': page_id} for page_id in page_ids]}
+
+
+class GradedMetricTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        path = os.path.join(self.temp_dir, 'judgments.tsv')
+        with open(path, 'w') as f:
+            # pageIds 2 and 3 are tied
+            f.write('# query, pageId, grade\nq\t1\t3\nq\t2\t2\nq\t3\t2\nq\t4\t0\n')
+        self.judgments = relcomp.Judgments(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def check(self, metric, x, y, expected):
+        score = metric.score(x, y)
+        if expected is None:
+            self.assertIsNone(score)
+        else:
+            self.assertAlmostEqual(expected, score)
+
+    def test_rbo(self):
+        rbo = relcomp.RankBiasedOverlap(depth=2, p=0.5)
+        self.check(rbo, ranking(1, 2), ranking(1, 2), 1.0)
+        self.check(rbo, ranking(1, 2), ranking(2, 1), 0.5)
+        self.check(rbo, ranking(1, 2), ranking(3, 4), 0.0)
+        # shorter lists are compared as if they were complete
+        self.check(rbo, ranking(1), ranking(1), 1.0)
+        self.check(rbo, ranking(1), ranking(1, 2), 0.75)
+        self.check(rbo, ranking(1, 1), ranking(1), 1.0)
+        self.check(rbo, ranking(), ranking(1), 0.0)
+        self.check(rbo, ranking(), {}, None)
+
+    def test_jaccard(self):
+        jaccard = relcomp.JaccardAtK(depth=3)
+        self.check(jaccard, ranking(1, 2, 3), ranking(2, 3, 4), 0.5)
+        self.check(jaccard, ranking(1, 2, 3), ranking(3, 2, 1), 1.0)
+        self.check(jaccard, ranking(1, 2), ranking(3, 4), 0.0)
+        self.check(jaccard, ranking(1, 1, 2), ranking(1, 2), 1.0)
+        self.check(jaccard, ranking(1, 2, 3, 4), ranking(4), 0.0)  # past depth
+        self.check(jaccard, ranking(), ranking(1), 0.0)
+        self.check(jaccard, ranking(), ranking(), None)
+
+    def test_kendall_tau(self):
+        tau = relcomp.KendallTau(depth=3)
+        self.check(tau, ranking(1, 2, 3), ranking(1, 2, 3), 1.0)
+        self.check(tau, ranking(1, 2, 3), ranking(3, 2, 1), -1.0)
+        self.check(tau, ranking(1, 2, 3), ranking(1, 3, 2), 1 / 3.0)
+        self.check(tau, ranking(1, 2, 9), ranking(8, 2, 1), -1.0)
+        self.check(tau, ranking(1, 1, 2), ranking(2, 1), -1.0)
+        self.check(tau, ranking(1, 2), ranking(1, 4), None)
+        self.check(tau, ranking(1, 2), ranking(3, 4), None)
+        self.check(tau, ranking(), ranking(), None)
+
+    def test_ndcg(self):
+        ndcg = relcomp.NDCG(depth=3, judgments=self.judgments)
+        idcg = 7 + 3 / numpy.log2(3) + 3 / 2.0
+        self.check(ndcg, ranking(1, 2, 3), ranking(), 1.0)
+        self.check(ndcg, ranking(1, 3, 2), ranking(), 1.0)  # tied grades
+        self.check(ndcg, ranking(2, 3, 1), ranking(), (3 + 3 / numpy.log2(3) + 7 / 2.0) / idcg)
+        self.check(ndcg, ranking(1, 1, 4), ranking(), 7 / idcg)
+        self.check(ndcg, ranking(5, 6), ranking(), 0.0)
+        self.check(ndcg, ranking(), ranking(), 0.0)
+        self.check(ndcg, {'query': u'unjudged', 'rows': [{'pageId': 1}]}, ranking(), None)
+
+    def test_err(self):
+        err = relcomp.ERR(depth=3, judgments=self.judgments)
+        self.check(err, ranking(1), ranking(), 7 / 8.0)
+        self.check(err, ranking(2, 1), ranking(), 3 / 8.0 + 5 / 8.0 * 7 / 8.0 / 2)
+        self.check(err, ranking(2, 3), ranking(3, 2), 3 / 8.0 + 5 / 8.0 * 3 / 8.0 / 2)
+        self.check(err, ranking(4, 5), ranking(), 0.0)
+        self.check(err, ranking(), ranking(), 0.0)
+        self.check(err, {'query': u'unjudged', 'rows': [{'pageId': 1}]}, ranking(), None)
+
+    def test_has_condition(self):
+        pairs = [((a, b) if n % 5 else (a, a)) for (n, (a, b)) in enumerate(make_pairs(500))]
+        for make in (lambda: relcomp.RankBiasedOverlap(depth=5),
+                     lambda: relcomp.KendallTau(depth=5),
+                     lambda: relcomp.NDCG(depth=5, judgments=self.judgments)):
+            # has_condition finds the same examples as measure_batch
+            (per_pair, batched) = (make(), make())
+            for (index, (a, b)) in enumerate(pairs, 1):
+                relcomp.Metric.measure(per_pair, dict(a, query=u'q'), dict(b, query=u'q'), index)
+            batched.measure_batch(make_batch([(dict(a, query=u'q'), dict(b, query=u'q'))
+                                              for (a, b) in pairs], 5))
+            self.assertEqual(batched.b2d_count, per_pair.b2d_count, per_pair.name)
+            self.assertEqual(batched.d2b_count, per_pair.d2b_count, per_pair.name)
+            self.assertTrue(0 < batched.b2d_count < len(pairs), per_pair.name)
+
+
+SPEC = """queryCount, zeroResults, topN topN=3 sorted=false, topN topN=5 sorted=true,
+    rbo depth=5, jaccard depth=5, kendallTau depth=5, ndcg depth=5, err depth=5"""
+
+
+class MeasureParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.file1 = os.path.join(self.temp_dir, 'a.jsonl')
+        self.file2 = os.path.join(self.temp_dir, 'b.jsonl')
+        self.judgments_file = os.path.join(self.temp_dir, 'judgments.tsv')
+        rng = random.Random(1)
+        with open(self.file1, 'w') as a, open(self.file2, 'w') as b:
+            for (n, pair) in enumerate(make_pairs(1000), 1):
+                for (f, results) in zip((a, b), pair):
+                    if n % 97 == 0:
+                        results = {'error': 'failed', 'query': results.get('query', '')}
+                    f.write('\n' if results == {} else json.dumps(results) + '\n')
+            a.write('{}\n' * 10)  # the delta is shorter
+        with open(self.judgments_file, 'w') as f:
+            for n in range(0, 1000, 2):
+                for page_id in rng.sample(range(1, 11), 4):
+                    f.write('query %d\t%d\t%d\n' % (n, page_id, rng.randint(0, 3)))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def measure_serial(self, printnum=20):
+        """Measure the files the way relcomp.py does with -j 1"""
+        judgments = relcomp.Judgments(self.judgments_file)
+        comparison = relcomp.Comparison(relcomp.parse_metrics(SPEC, printnum, judgments),
+                                        features=True)
+        with open(self.file1) as a, open(self.file2) as b:
+            for (index, (aline, bline)) in enumerate(izip_longest(a, b, fillvalue="{}"), 1):
+                comparison.add(index, fastjson.extract_results(aline),
+                               fastjson.extract_results(bline))
+        comparison.flush()
+        return (comparison.metrics, comparison.errors, comparison.diff_count,
+                comparison.feature_columns())
+
+    def test_same_as_serial(self):
+        (metrics, errors, diff_count, columns) = self.measure_serial()
+        (all_examples, _, _, _) = self.measure_serial(printnum=10000)
+        parallel = relcomp.parse_metrics(SPEC, 20, relcomp.Judgments(self.judgments_file))
+        result = relcomp.measure_parallel(self.file1, self.file2, parallel, SPEC, 20,
+                                          self.judgments_file, 3, chunk_size=37, features=True)
+        self.assertEqual((errors, diff_count), result[0:2])
+        self.assertEqual(1010, diff_count)
+        self.assertEqual(sorted(columns), sorted(result[2]))
+        for name in columns:
+            numpy.testing.assert_array_equal(columns[name], result[2][name], name)
+
+        for (serial, merged, everything) in zip(metrics, parallel, all_examples):
+            (expected, state) = (serial.state(), merged.state())
+            for count in COUNTS:
+                self.assertEqual(expected[count], state[count], "%s %s" % (serial.name, count))
+            for side in ('b2d_diff', 'd2b_diff'):
+                if serial.printset == 'random':
+                    # a sample of all the examples, of the same size
+                    self.assertEqual(len(expected[side]), len(state[side]))
+                    self.assertTrue(set(ex[1] for ex in state[side]) <=
+                                    set(ex[1] for ex in everything.state()[side]))
+                else:
+                    self.assertEqual(sorted(expected[side]), sorted(state[side]),
+                                     "%s %s" % (serial.name, side))
+            if isinstance(serial, relcomp.GradedMetric):
+                for side in ('baseline_scores', 'delta_scores'):
+                    self.assertEqual(expected[side].count, state[side].count)
+                    self.assertAlmostEqual(expected[side].total, state[side].total)
+                    self.assertEqual(expected[side].histogram.tolist(),
+                                     state[side].histogram.tolist())
+                self.assertEqual(expected['change_counts'].tolist(),
+                                 state['change_counts'].tolist())
+        self.assertTrue(all(m.b2d_count for m in metrics[1:]))
+
+
+class BootstrapTest(unittest.TestCase):
+    def test_interval(self):
+        # a known mean change of 0.25 over 4000 queries
+        values = numpy.array([-1.0, 0.0, 1.0])
+        counts = numpy.array([500, 2000, 1500])
+        (low, high) = relcomp.bootstrap(values, counts, 2000)
+        self.assertTrue(low < 0.25 < high, (low, high))
+        self.assertTrue(high - low < 0.1, (low, high))
+        self.assertEqual((low, high), relcomp.bootstrap(values, counts, 2000))
+        self.assertEqual((low, high), relcomp.bootstrap(values, counts, 2000, seed=0))
+        self.assertNotEqual((low, high), relcomp.bootstrap(values, counts, 2000, seed=1))
+        self.assertEqual(relcomp.bootstrap(values, counts, 2000, seed=1),
+                         relcomp.bootstrap(values, counts, 2000, seed=1))
+
+    def test_metric_interval(self):
+        pairs = make_pairs(1000)
+        intervals = []
+        for _ in range(2):
+            metric = relcomp.ZeroResultsRate()
+            for (index, (a, b)) in enumerate(pairs, 1):
+                metric.measure(a, b, index)
+            summary = metric.summary(1000, seed=5)
+            intervals.append((summary['ci_low'], summary['ci_high']))
+            self.assertTrue(summary['ci_low'] <= summary['change'] <= summary['ci_high'])
+        self.assertEqual(intervals[0], intervals[1])
+
+
+if __name__ == '__main__':
+    unittest.main()